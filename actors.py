@@ -0,0 +1,367 @@
+# Matt Corsaro
+# Brown University CS 2951X Final Project
+# Skill chaining for continuous Lunar Lander
+# Distributed experience collection: actor processes each step their own LunarLander with their own epsilon, act with
+# a numpy copy of the learner's Q network, and write transitions into a replay in shared memory that one learner
+# consumes. Actors on other machines reach the learner through a socket transport instead.
+import numpy as np
+
+import time
+import os
+import sys
+import random
+import pickle
+import binascii
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+import argparse
+
+from skilltree import global_idx
+
+# Transitions buffered by an actor before being written to the replay
+send_every = 50
+# Steps between an actor checking for new weights and option trees
+pull_every = 400
+# Room for the pickled option tree snapshot
+tree_capacity = int(5e7)
+# Ape-X style per-actor exploration: actor i of N uses epsilon_base**(1 + epsilon_alpha*i/(N-1))
+epsilon_base = 0.4
+epsilon_alpha = 7.
+
+def actorEpsilon(actor_id, num_actors):
+    if num_actors == 1:
+        return epsilon_base
+    return epsilon_base**(1 + epsilon_alpha*actor_id/(num_actors - 1.))
+
+def listenAuthkey(authkey):
+    # The replay server unpickles whatever its connections send, so it never listens without a secret key
+    if authkey == None or authkey == '':
+        authkey = binascii.hexlify(os.urandom(16))
+        print "Generated authkey", authkey, "for remote actors, pass it to actors.py with --authkey"
+    return authkey
+
+def parseAddress(address):
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+def forward(weights, states):
+    # numpy version of generate_network, weights are [kernel, bias, kernel, bias, ...] of one network
+    hidden = states
+    for i in range(0, len(weights), 2):
+        hidden = hidden.dot(weights[i]) + weights[i + 1]
+        if i < len(weights) - 2:
+            hidden = np.maximum(hidden, 0)
+    return hidden
+
+# Ring buffer of (s, a, r, s', not terminal, option index) transitions in shared memory, written by the actors and
+# read by the learner. Every transition ever written has a sequence number, so the learner can either sample from it
+# as its replay or read what was added since its last read.
+class SharedReplay(object):
+    def __init__(self, capacity, state_dim):
+        self.capacity = capacity
+        self.state_dim = state_dim
+        self.lock = multiprocessing.Lock()
+        # number of transitions written so far
+        self.count = multiprocessing.RawValue('l', 0)
+        # RawArrays are inherited by forked actors, so the numpy views below share memory with theirs
+        self.states = np.frombuffer(multiprocessing.RawArray('f', capacity*state_dim), dtype=np.float32)\
+            .reshape(capacity, state_dim)
+        self.actions = np.frombuffer(multiprocessing.RawArray('i', capacity), dtype=np.int32)
+        self.rewards = np.frombuffer(multiprocessing.RawArray('f', capacity), dtype=np.float32)
+        self.next_states = np.frombuffer(multiprocessing.RawArray('f', capacity*state_dim), dtype=np.float32)\
+            .reshape(capacity, state_dim)
+        self.not_terminal = np.frombuffer(multiprocessing.RawArray('f', capacity), dtype=np.float32)
+        self.opt_idx = np.frombuffer(multiprocessing.RawArray('i', capacity), dtype=np.int32)
+        self.columns = [self.states, self.actions, self.rewards, self.next_states, self.not_terminal, self.opt_idx]
+
+    def __len__(self):
+        return min(self.count.value, self.capacity)
+
+    def append(self, batch):
+        # batch: one array per column, all of the same length
+        with self.lock:
+            start = self.count.value
+            rows = (start + np.arange(len(batch[1]))) % self.capacity
+            for column, values in zip(self.columns, batch):
+                column[rows] = values
+            self.count.value = start + len(rows)
+
+    def sample(self, batch_size):
+        # copied under the lock so a sample never mixes parts of a transition with the one overwriting it
+        with self.lock:
+            rows = np.random.randint(len(self), size=batch_size)
+            return [column[rows] for column in self.columns]
+
+    def read(self, since):
+        # transitions written after sequence number since (those already overwritten are lost), and the new cursor
+        with self.lock:
+            count = self.count.value
+            rows = np.arange(max(since, count - self.capacity), count) % self.capacity
+            return [column[rows] for column in self.columns], count
+
+# Flat float32 copy of a list of weight arrays in shared memory, with a version number bumped on every publish
+class SharedWeights(object):
+    def __init__(self, shapes):
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.lock = multiprocessing.Lock()
+        self.version = multiprocessing.RawValue('l', 0)
+        self.flat = np.frombuffer(multiprocessing.RawArray('f', sum(self.sizes)), dtype=np.float32)
+
+    def publish(self, weights):
+        with self.lock:
+            self.flat[:] = np.concatenate([np.asarray(w, dtype=np.float32).ravel() for w in weights])
+            self.version.value += 1
+
+    def pull(self, version):
+        # (weights, version), weights is None if nothing newer than version was published
+        if self.version.value == version:
+            return None, version
+        with self.lock:
+            flat = self.flat.copy()
+            version = self.version.value
+        weights = []
+        offset = 0
+        for shape, size in zip(self.shapes, self.sizes):
+            weights.append(flat[offset:offset + size].reshape(shape))
+            offset += size
+        return weights, version
+
+# Any picklable object in shared memory, used for the option tree snapshots
+class SharedBlob(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = multiprocessing.Lock()
+        self.version = multiprocessing.RawValue('l', 0)
+        self.length = multiprocessing.RawValue('l', 0)
+        self.data = multiprocessing.RawArray('c', capacity)
+
+    def publish(self, obj):
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.capacity:
+            raise ValueError("Object of " + str(len(data)) + " bytes doesn't fit in shared blob")
+        with self.lock:
+            self.data[:len(data)] = data
+            self.length.value = len(data)
+            self.version.value += 1
+
+    def pull(self, version):
+        if self.version.value == version:
+            return None, version
+        with self.lock:
+            data = self.data[:self.length.value]
+            version = self.version.value
+        return pickle.loads(data), version
+
+# What an actor talks to: the fleet's shared memory when forked by the learner
+class LocalTransport(object):
+    def __init__(self, fleet):
+        self.fleet = fleet
+
+    def send(self, batch, reports):
+        self.fleet.replay.append(batch)
+        for report in reports:
+            self.fleet.reports.put(report)
+        return self.fleet.stop_event.is_set()
+
+    def pullWeights(self, version):
+        return self.fleet.weights.pull(version)
+
+    def pullTree(self, version):
+        return self.fleet.tree.pull(version)
+
+# ... or a connection to the learner's ReplayServer when running on another node
+class SocketTransport(object):
+    def __init__(self, address, authkey):
+        self.conn = Client(address, authkey=authkey)
+
+    def send(self, batch, reports):
+        self.conn.send(('send', batch, reports))
+        return self.conn.recv()
+
+    def pullWeights(self, version):
+        self.conn.send(('weights', version))
+        return self.conn.recv()
+
+    def pullTree(self, version):
+        self.conn.send(('tree', version))
+        return self.conn.recv()
+
+# Accepts socket connections from remote actors and serves them from the fleet's shared memory
+class ReplayServer(object):
+    def __init__(self, fleet, address, authkey):
+        self.fleet = fleet
+        self.listener = Listener(address, authkey=authkey)
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            conn = self.listener.accept()
+            print "Remote actor connected from", self.listener.last_accepted
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, conn):
+        transport = LocalTransport(self.fleet)
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, IOError):
+                break
+            if message[0] == 'send':
+                conn.send(transport.send(message[1], message[2]))
+            elif message[0] == 'weights':
+                conn.send(transport.pullWeights(message[1]))
+            elif message[0] == 'tree':
+                conn.send(transport.pullTree(message[1]))
+        conn.close()
+
+# Actor processes on this machine plus the shared memory they write to. Start it before creating a tf.Session, forking
+# a process that has one is not safe.
+class ActorFleet(object):
+    def __init__(self, num_actors, mode, state_dim, max_steps_ep, replay_capacity, weight_shapes, \
+            listen = None, authkey = None, total_actors = None):
+        self.num_actors = num_actors
+        self.mode = mode
+        self.replay = SharedReplay(replay_capacity, state_dim)
+        self.weights = SharedWeights(weight_shapes)
+        self.tree = SharedBlob(tree_capacity)
+        # (actor id, episode reward, steps, epsilon) for every finished actor episode
+        self.reports = multiprocessing.Queue()
+        self.stop_event = multiprocessing.Event()
+        self.actor_args = (mode, max_steps_ep, total_actors or num_actors)
+        self.processes = []
+        self.server = ReplayServer(self, parseAddress(listen), listenAuthkey(authkey)) if listen else None
+
+    def start(self):
+        for actor_id in range(self.num_actors):
+            process = multiprocessing.Process(target=runActor, \
+                args=(actor_id, LocalTransport(self)) + self.actor_args)
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        print "Started", self.num_actors, self.mode, "actors."
+
+    def stop(self):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(10)
+
+    def publishWeights(self, weights):
+        self.weights.publish(weights)
+
+    def publishTree(self, tree):
+        self.tree.publish(tree)
+
+    def episodeReports(self):
+        reports = []
+        while not self.reports.empty():
+            reports.append(self.reports.get())
+        return reports
+
+def runActor(actor_id, transport, mode, max_steps_ep, num_actors):
+    # gym is only needed by the actors
+    import gym
+    env = gym.make("LunarLander-v2")
+    n_actions = env.action_space.n
+    seed = (os.getpid()*1000 + actor_id) % 2**31
+    env.seed(seed)
+    np.random.seed(seed)
+    epsilon = actorEpsilon(actor_id, num_actors)
+    print "Actor", actor_id, "running with epsilon", epsilon
+
+    # wait for the learner's first weights (and option tree)
+    weights, weights_version = None, 0
+    tree, tree_version = None, 0
+    while weights is None or (mode == "sc" and tree is None):
+        new_weights, weights_version = transport.pullWeights(weights_version)
+        weights = new_weights if new_weights is not None else weights
+        if mode == "sc":
+            new_tree, tree_version = transport.pullTree(tree_version)
+            tree = new_tree if new_tree is not None else tree
+        time.sleep(0.1)
+
+    batch = []
+    reports = []
+    total_steps = 0
+    stopped = False
+    while not stopped:
+        observation = env.reset()
+        opt = global_idx
+        total_reward = 0
+        for t in range(max_steps_ep):
+            # the global MDP follows the first option whose initiation set it enters, as in skillchain_lunarlander.py
+            if mode == "sc" and opt == global_idx:
+                opt = tree.findOption(observation[:2])
+
+            if np.random.random() < epsilon:
+                action = np.random.randint(n_actions)
+            elif mode == "sc":
+                action = np.argmax(forward([w[opt] for w in weights], observation))
+            else:
+                action = np.argmax(forward(weights, observation))
+
+            next_observation, reward, done, _info = env.step(action)
+            total_reward += reward
+            batch.append((observation, action, reward, next_observation, 0.0 if done else 1.0, opt))
+            observation = next_observation
+            total_steps += 1
+
+            if mode == "sc" and tree.inTerminationSet(opt, observation, done):
+                opt = tree.parents[opt]
+            if done:
+                break
+
+            if len(batch) >= send_every:
+                stopped = transport.send([np.asarray([elem[i] for elem in batch]) for i in range(6)], reports)
+                batch = []
+                reports = []
+                if stopped:
+                    break
+
+            if total_steps%pull_every == 0:
+                new_weights, weights_version = transport.pullWeights(weights_version)
+                weights = new_weights if new_weights is not None else weights
+                if mode == "sc":
+                    new_tree, tree_version = transport.pullTree(tree_version)
+                    tree = new_tree if new_tree is not None else tree
+        reports.append((actor_id, total_reward, t + 1, epsilon))
+    env.close()
+
+def main():
+    # Runs actors on a node other than the learner's, connected to the learner's --listen address
+    parser = argparse.ArgumentParser(description = "Lunar Lander remote actors")
+    parser.add_argument("--connect", type=str, required=True, help="learner's --listen address, host:port")
+    parser.add_argument("--authkey", type=str, required=True, help="the learner's authkey")
+    parser.add_argument("--mode", type=str, choices=["dqn", "sc"], default="dqn")
+    parser.add_argument("--actors", type=int, default=multiprocessing.cpu_count())
+    # actor ids (and epsilons) are numbered across all nodes
+    parser.add_argument("--first-actor", type=int, default=0)
+    parser.add_argument("--total-actors", type=int, default=None)
+    parser.add_argument("--max-steps-ep", type=int, default=1000)
+    args = parser.parse_args()
+
+    total_actors = args.total_actors or args.first_actor + args.actors
+    processes = []
+    for actor_id in range(args.first_actor, args.first_actor + args.actors):
+        # every actor opens its own connection, after the fork
+        process = multiprocessing.Process(target=runRemoteActor, args=(actor_id, parseAddress(args.connect), \
+            args.authkey, args.mode, args.max_steps_ep, total_actors))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+def runRemoteActor(actor_id, address, authkey, mode, max_steps_ep, num_actors):
+    try:
+        runActor(actor_id, SocketTransport(address, authkey), mode, max_steps_ep, num_actors)
+    except (EOFError, IOError):
+        print "Actor", actor_id, "lost its connection to the learner."
+
+if __name__ == '__main__':
+    main()
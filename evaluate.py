@@ -0,0 +1,80 @@
+# Matt Corsaro
+# Brown University CS 2951X Final Project
+# Skill chaining for continuous Lunar Lander
+# Plays a trained DQN checkpoint or skill tree greedily with numpy inference, without building the training graph
+import numpy as np
+
+import time
+import os
+import sys
+
+import argparse
+
+from actors import forward
+from skilltree import global_idx, loadSkillTree
+from trajectories import TrajectoryRecorder
+
+def main():
+    parser = argparse.ArgumentParser(description = "Evaluate a trained Lunar Lander policy")
+    parser.add_argument("--model", type=str, default="", help="DQN checkpoint saved by lunarlander.py")
+    parser.add_argument("--skill-tree", type=str, default="", help="skill tree saved by skillchain_lunarlander.py")
+    parser.add_argument("--episodes", type=int, default=10)
+    parser.add_argument("--max-steps-ep", type=int, default=1000)
+    parser.add_argument('--visualize', dest='visualize', action='store_true')
+    parser.add_argument('--no-visualize', dest='visualize', action='store_false')
+    parser.set_defaults(visualize=False)
+    parser.add_argument("--record", type=str, default="", \
+        help="directory to record episodes to, for render_trajectories.py")
+    args = parser.parse_args()
+
+    if (args.model == '') == (args.skill_tree == ''):
+        parser.error("give one of --model and --skill-tree")
+    if args.model != '':
+        # reading the checkpoint is the only thing TensorFlow is needed for
+        from policy_server import loadDQNCheckpoint
+        print "Loading trained model from", args.model
+        weights, tree, names = loadDQNCheckpoint(args.model), None, None
+    else:
+        print "Loading skill tree from", args.skill_tree
+        weights, tree, names = loadSkillTree(args.skill_tree)
+
+    import gym
+    env = gym.make("LunarLander-v2")
+    recorder = TrajectoryRecorder(args.record, env.observation_space.shape[0], args.max_steps_ep) \
+        if args.record != '' else None
+    rewards = []
+    print "Load successful, playing for", args.episodes, "games."
+    for ep in range(args.episodes):
+        observation = env.reset()
+        if recorder != None:
+            recorder.startEpisode(ep, observation)
+        opt = global_idx
+        total_reward = 0
+        steps = 0
+        for t in range(args.max_steps_ep):
+            if tree is None:
+                action = np.argmax(forward(weights, observation))
+            else:
+                if opt == global_idx:
+                    opt = tree.findOption(observation[:2])
+                action = np.argmax(forward([w[opt] for w in weights], observation))
+            observation, reward, done, _info = env.step(action)
+            if recorder != None:
+                recorder.step(action, reward, opt, observation)
+            total_reward += reward
+            if args.visualize:
+                env.render()
+            steps += 1
+            if tree is not None and tree.inTerminationSet(opt, observation, done):
+                opt = tree.parents[opt]
+            if done:
+                break
+        if recorder != None:
+            recorder.endEpisode(tree, names, tree_version = 0)
+        rewards.append(total_reward)
+        print "Reward:", total_reward, "in", steps, "steps."
+    print "Mean reward:", np.mean(rewards), "over", args.episodes, "games."
+    env.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Matt Corsaro
+# Brown University CS 2951X Final Project
+# Skill chaining for continuous Lunar Lander
+# Parallel hyperparameter search over the skill chaining constants, with asynchronous successive halving: a trial that
+# reaches a rung keeps running only if its score is in the top 1/eta of all scores recorded at that rung so far.
+import numpy as np
+
+import time
+import os
+from os import path
+import sys
+import random
+import re
+import json
+import subprocess
+import signal
+import errno
+import threading
+import Queue
+
+import argparse
+
+# Values tried for each module-level constant of skillchain_lunarlander.py
+search_space = {
+    # Skill chain params
+    'max_steps_opt': [15, 25, 50],
+    'max_neg_traj': [100, 250, 500],
+    'num_ep_init_class': [25, 50, 100],
+    'max_num_init_ex': [3000, 6000, 12000],
+    'epsilon_drop_episode': [600, 800, 900],
+    # DQN params
+    'lr': [2e-5, 5e-5, 1e-4],
+    'minibatch_size': [256, 512, 1024],
+    'update_slow_target_every': [50, 100, 500],
+    'epsilon_decay_length': [5000, 10000, 20000],
+    'epsilon_decay_exp': [0.95, 0.98, 0.99],
+}
+
+script = path.join(path.dirname(path.abspath(__file__)), "skillchain_lunarlander.py")
+# Matches the per-episode line printed by skillchain_lunarlander.py
+episode_re = re.compile(r'^Episode\s+(\d+), Reward:\s*(\S+),')
+
+def sampleParams(rng):
+    return dict((name, rng.choice(values)) for name, values in sorted(search_space.items()))
+
+def rungEpisodes(min_episodes, eta, num_episodes):
+    rungs = []
+    rung = min_episodes
+    while rung < num_episodes:
+        rungs.append(rung)
+        rung *= eta
+    return rungs
+
+def score(rewards, window):
+    return float(np.mean(rewards[-window:]))
+
+def loadResults(results_file):
+    if path.exists(results_file):
+        with open(results_file) as f:
+            return json.load(f)
+    return {'trials': []}
+
+def saveResults(results, results_file):
+    # write then rename, so an interrupted search never leaves a truncated results file
+    with open(results_file + '.tmp', 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    os.rename(results_file + '.tmp', results_file)
+
+def keepRunning(trial, rung, trials, eta):
+    rung_scores = sorted([t['rung_scores'][str(rung)] for t in trials if str(rung) in t['rung_scores']], reverse=True)
+    num_kept = max(1, len(rung_scores)//eta)
+    return trial['rung_scores'][str(rung)] >= rung_scores[num_kept - 1]
+
+def launchTrial(trial, trial_dir, events, num_episodes):
+    if not path.exists(trial_dir):
+        os.makedirs(trial_dir)
+    # constants derived from num_episodes (add_opt_cutoff, ...) follow it unless searched over themselves
+    command = [sys.executable, '-u', script, '--param', 'num_episodes=' + str(num_episodes)]
+    for name, value in sorted(trial['params'].items()):
+        command += ['--param', name + '=' + repr(value)]
+    # each trial writes its boards and plots to its own directory
+    log = open(path.join(trial_dir, "output.txt"), 'w')
+    # in its own process group, so stopping it also stops its classifier workers and actors
+    proc = subprocess.Popen(command, cwd=trial_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, \
+        preexec_fn=os.setsid)
+
+    def readOutput():
+        for line in iter(proc.stdout.readline, ''):
+            log.write(line)
+            events.put((trial['id'], line))
+        log.close()
+        events.put((trial['id'], None))
+    reader = threading.Thread(target=readOutput)
+    reader.daemon = True
+    reader.start()
+    return proc
+
+def stopTrial(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError as e:
+        # the whole group already exited
+        if e.errno != errno.ESRCH:
+            raise
+
+def printLeaderboard(trials, rungs, window):
+    def rank(trial):
+        reached = [rung for rung in rungs if str(rung) in trial['rung_scores']]
+        final = score(trial['rewards'], window) if trial['status'] == "completed" else None
+        return (trial['status'] == "completed", len(reached), final if final != None else \
+            (trial['rung_scores'][str(reached[-1])] if reached else -np.inf))
+    print "Trial  Status     Episodes  Score      Params"
+    for trial in sorted(trials, key=rank, reverse=True):
+        print '%5i  %-9s  %8i  %9.3f  %s'%(trial['id'], trial['status'], len(trial['rewards']), rank(trial)[2], \
+            ' '.join(name + '=' + str(value) for name, value in sorted(trial['params'].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description = "Hyperparameter search for skill chaining Lunar Lander")
+    parser.add_argument("--results", type=str, default="search_results.json", \
+        help="results file, an existing one is resumed")
+    parser.add_argument("--trials", type=int, default=27)
+    parser.add_argument("--workers", type=int, default=4, help="trials run in parallel")
+    # length of a full trial, passed to skillchain_lunarlander.py as num_episodes
+    parser.add_argument("--episodes", type=int, default=1000)
+    parser.add_argument("--min-episodes", type=int, default=100, help="episodes before the first rung")
+    parser.add_argument("--eta", type=int, default=3, help="keep the top 1/eta of trials at each rung")
+    parser.add_argument("--window", type=int, default=50, help="trailing episodes averaged into a trial's score")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = loadResults(args.results)
+    trials = results['trials']
+    if len(trials) == 0:
+        rng = random.Random(args.seed)
+        for i in range(args.trials):
+            trials.append({'id': i, 'params': sampleParams(rng), 'status': "queued", 'rewards': [], \
+                'rung_scores': {}})
+    else:
+        print "Resuming search from", args.results
+    rungs = rungEpisodes(args.min_episodes, args.eta, args.episodes)
+    print "Rungs at episodes", rungs
+
+    # runs can't be resumed mid-way, so trials interrupted with the search start over
+    queued = []
+    for trial in trials:
+        if trial['status'] in ["queued", "running"]:
+            trial['status'] = "queued"
+            trial['rewards'] = []
+            trial['rung_scores'] = {}
+            queued.append(trial)
+    saveResults(results, args.results)
+    print len(queued), "of", len(trials), "trials left to run."
+
+    results_dir = path.splitext(path.abspath(args.results))[0]
+    events = Queue.Queue()
+    running = {}
+    start_time = time.time()
+    try:
+        while len(queued) != 0 or len(running) != 0:
+            while len(queued) != 0 and len(running) < args.workers:
+                trial = queued.pop(0)
+                print "Starting trial", trial['id'], "with", trial['params']
+                trial['status'] = "running"
+                running[trial['id']] = (trial, launchTrial(trial, path.join(results_dir, str(trial['id'])), events, \
+                    args.episodes))
+                saveResults(results, args.results)
+
+            # the Queue.get timeout keeps the loop interruptible with ctrl-c
+            try:
+                trial_id, line = events.get(timeout=1)
+            except Queue.Empty:
+                continue
+            trial, proc = running[trial_id]
+
+            if line == None:
+                returncode = proc.wait()
+                if trial['status'] == "running":
+                    completed = returncode == 0 and len(trial['rewards']) >= args.episodes
+                    trial['status'] = "completed" if completed else "failed"
+                print "Trial", trial_id, trial['status'], "after", len(trial['rewards']), "episodes,", \
+                    "minutes:", (time.time() - start_time)/60
+                del running[trial_id]
+                saveResults(results, args.results)
+                continue
+
+            match = episode_re.match(line)
+            if match == None or trial['status'] != "running":
+                continue
+            trial['rewards'].append(float(match.group(2)))
+            num_episodes = len(trial['rewards'])
+            if num_episodes in rungs:
+                trial['rung_scores'][str(num_episodes)] = score(trial['rewards'], args.window)
+                if not keepRunning(trial, num_episodes, trials, args.eta):
+                    print "Stopping trial", trial_id, "at episode", num_episodes, "with score", \
+                        trial['rung_scores'][str(num_episodes)]
+                    trial['status'] = "stopped"
+                    stopTrial(proc)
+                saveResults(results, args.results)
+    except KeyboardInterrupt:
+        print "Interrupted, rerun with the same --results to resume."
+        for trial, proc in running.values():
+            stopTrial(proc)
+        saveResults(results, args.results)
+        return
+
+    printLeaderboard(trials, rungs, args.window)
+
+if __name__ == '__main__':
+    main()
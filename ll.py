@@ -0,0 +1,70 @@
+# Matt Corsaro
+# Brown University CS 2951X Final Project
+# Skill chaining for continuous Lunar Lander
+# Single entry point: python ll.py <command> [command arguments]. Only the modules a command needs are imported, and
+# the time spent on imports before the command starts is reported.
+import time
+start_time = time.time()
+
+import sys
+import importlib
+
+# command: (module whose main() runs it, heavy modules it needs, default arguments, description). A heavy module can be
+# (module, flag) when only needed if the flag is given. Default arguments are (arguments, flags that replace them) and
+# are added before the user's unless the user gives one of those flags.
+checkpoint_tf = ('tensorflow', '--model')
+default_model = (['--model', 'trained_dqn/2018_05_14_15_49_38.ckpt'], ['--model', '--skill-tree'])
+commands = {
+    'train-dqn': ('lunarlander', ['numpy', 'gym', 'tensorflow'], [], "train a DQN"),
+    'train-sc': ('skillchain_lunarlander', ['numpy', 'gym', 'tensorflow', 'sklearn.svm', 'anytree'], [], \
+        "train a skill tree"),
+    'play': ('evaluate', ['numpy', 'gym', checkpoint_tf], [(['--visualize'], ['--no-visualize']), default_model], \
+        "watch a trained DQN or skill tree (default: the DQN in trained_dqn)"),
+    'eval': ('evaluate', ['numpy', 'gym', checkpoint_tf], [], "report the reward of a trained DQN or skill tree"),
+    'plot': ('plots_from_boards', ['numpy', 'matplotlib.pyplot', 'tensorboard.backend.event_processing'], [], \
+        "plot rewards from TensorBoard logs"),
+    'render': ('render_trajectories', ['numpy', 'matplotlib'], [], "render episodes recorded with --record"),
+    'search': ('hyperparam_search', ['numpy'], [], "hyperparameter search over skill chaining constants"),
+    'serve': ('policy_server', ['numpy', checkpoint_tf], [], "serve actions from a trained DQN or skill tree"),
+}
+
+def givenFlags(args):
+    # --flag and --flag=value both give --flag
+    return set(arg.split('=', 1)[0] for arg in args if arg.startswith('-'))
+
+def usage():
+    print "usage: python ll.py <command> [-h] [arguments]"
+    print
+    for name in sorted(commands):
+        print '  %-10s %s'%(name, commands[name][3])
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        usage()
+        sys.exit(0 if len(sys.argv) >= 2 and sys.argv[1] in ['-h', '--help'] else 2)
+    name = sys.argv[1]
+    module_name, heavy_modules, default_args, _description = commands[name]
+    user_args = sys.argv[2:]
+    given = givenFlags(user_args)
+    args = sum([default for default, replaced_by in default_args if len(given & set(replaced_by)) == 0], []) + user_args
+    sys.argv = [sys.argv[0] + ' ' + name] + args
+
+    import_times = []
+    # --help only needs argparse
+    if not ('-h' in user_args or '--help' in user_args):
+        for heavy_module in heavy_modules:
+            if isinstance(heavy_module, tuple):
+                heavy_module, flag = heavy_module
+                if flag not in givenFlags(args):
+                    continue
+            import_start = time.time()
+            importlib.import_module(heavy_module)
+            import_times.append((heavy_module, time.time() - import_start))
+    command = importlib.import_module(module_name)
+    if len(import_times) != 0:
+        print 'Startup: %.2f s, imports: %s'%(time.time() - start_time, \
+            ', '.join('%s %.2f s'%(heavy_module, seconds) for heavy_module, seconds in import_times))
+    command.main()
+
+if __name__ == '__main__':
+    main()
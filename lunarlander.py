@@ -4,9 +4,6 @@
 # Original DQN code from:
 # https://gist.github.com/heerad/d2b92c2f3a83b5e4be395546c17b274c#file-dqn-lunarlander-v2-py
 import numpy as np
-import gym
-from gym import wrappers
-import tensorflow as tf
 
 import time
 import datetime
@@ -18,6 +15,11 @@ from collections import deque
 
 import argparse
 
+from actors import ActorFleet
+from replay_schedule import ReplayRatioScheduler
+from skilltree import global_idx
+from trajectories import TrajectoryRecorder
+
 def main():
 
     parser = argparse.ArgumentParser(description = "Lunar Lander")
@@ -25,7 +27,31 @@ def main():
     parser.add_argument('--no-visualize', dest='visualize', action='store_false')
     parser.set_defaults(visualize=False)
     parser.add_argument("--model", type=str, default="")
+    # Distributed collection: actor processes step their own environments and feed a shared-memory replay
+    parser.add_argument("--actors", type=int, default=0, \
+        help="number of local actor processes, 0 to train inline unless --listen is given")
+    parser.add_argument("--listen", type=str, default="", help="host:port to accept remote actors (actors.py) on")
+    parser.add_argument("--authkey", type=str, default="", \
+        help="secret remote actors connect with, generated and printed if not given")
+    parser.add_argument("--total-actors", type=int, default=0, \
+        help="actors on all nodes, for the per-actor epsilons, default --actors")
+    parser.add_argument('--schedule-batch', dest='schedule_batch', action='store_true', \
+        help="trade update count against batch size based on measured update times")
+    parser.set_defaults(schedule_batch=False)
+    parser.add_argument("--record", type=str, default="", \
+        help="directory to record episodes to, for render_trajectories.py")
+    parser.add_argument("--record-every", type=int, default=1, help="record every this many episodes")
     args = parser.parse_args()
+    if args.schedule_batch and args.model == '' and (args.actors > 0 or args.listen != ''):
+        # the learner isn't paced by environment steps there, so there is no replay ratio to keep
+        parser.error("--schedule-batch only applies to inline training, not with --actors or --listen")
+    if args.record != '' and args.model == '' and (args.actors > 0 or args.listen != ''):
+        # the episodes are played by the actors, which don't record them
+        parser.error("--record only applies to inline training, not with --actors or --listen")
+
+    # heavy imports only once the arguments are parsed, so --help stays fast
+    import gym
+    import tensorflow as tf
 
     # DQN Params
     gamma = 0.99
@@ -49,6 +75,8 @@ def main():
     epsilon_end = 0.05
     epsilon_decay_length = 10000
     epsilon_decay_exp = 0.98
+    # gradient steps between publishing the Q network to the actors
+    publish_weights_every = 100
 
     # game parameters
     env = gym.make("LunarLander-v2")
@@ -67,6 +95,7 @@ def main():
     reward_ph = tf.placeholder(dtype=tf.float32, shape=[None]) # rewards (go into target computation)
     is_not_terminal_ph = tf.placeholder(dtype=tf.float32, shape=[None]) # indicators (go into target computation)
     is_training_ph = tf.placeholder(dtype=tf.bool, shape=()) # for dropout
+    lr_ph = tf.placeholder_with_default(lr, shape=()) # learning rate, scaled with the batch size
 
     episode_reward = tf.Variable(0.)
     tf.summary.scalar("Episode Reward", episode_reward)
@@ -119,12 +148,14 @@ def main():
 
     update_slow_target_op = tf.group(*update_slow_target_ops, name='update_slow_target')
 
+    # batch size is whatever was fed
+    batch_range = tf.range(tf.shape(action_ph)[0])
     targets = reward_ph + is_not_terminal_ph * gamma * \
-        tf.gather_nd(slow_target_action_values, tf.stack((tf.range(minibatch_size), \
+        tf.gather_nd(slow_target_action_values, tf.stack((batch_range, \
             tf.cast(tf.argmax(q_action_values_next, axis=1), tf.int32)), axis=1))
 
     # Estimated Q values for (s,a) from experience replay
-    estim_taken_action_vales = tf.gather_nd(q_action_values, tf.stack((tf.range(minibatch_size), action_ph), axis=1))
+    estim_taken_action_vales = tf.gather_nd(q_action_values, tf.stack((batch_range, action_ph), axis=1))
 
     # loss function (with regularization)
     loss = tf.reduce_mean(tf.square(targets - estim_taken_action_vales))
@@ -133,7 +164,15 @@ def main():
             loss += l2_reg * 0.5 * tf.nn.l2_loss(var)
 
     # optimizer
-    train_op = tf.train.AdamOptimizer(lr*lr_decay**episodes).minimize(loss)
+    train_op = tf.train.AdamOptimizer(lr_ph*lr_decay**episodes).minimize(loss)
+
+    # actors have to be forked before the session is created
+    distributed = args.model == '' and (args.actors > 0 or args.listen != '')
+    if distributed:
+        fleet = ActorFleet(args.actors, "dqn", state_dim, max_steps_ep, replay_memory_capacity, \
+            [var.get_shape().as_list() for var in q_network_vars], listen = args.listen, authkey = args.authkey, \
+            total_actors = args.total_actors or None)
+        fleet.start()
 
     # initialize session
     sess = tf.Session()
@@ -145,7 +184,52 @@ def main():
     board_name = "board_" + timestamp
     saver = tf.train.Saver()
     start_time = time.time()
-    if args.model == '':
+    if distributed:
+        #####################################################################################################
+        ## Distributed training: only learn here, actors report their episodes
+        print "Training a new model with", args.actors, "local actors."
+        writer = tf.summary.FileWriter(board_name)
+        writer.add_graph(sess.graph)
+
+        fleet.publishWeights(sess.run(q_network_vars))
+        num_updates = 0
+        ep = 0
+        while ep < num_episodes:
+            for actor_id, total_reward, steps_in_ep, actor_epsilon in fleet.episodeReports():
+                _ = sess.run(episode_inc_op)
+                sess.run(update_ep_reward, feed_dict={r_summary_placeholder: total_reward})
+                sess.run(update_plot_epsilon, feed_dict={eps_summary_placeholder: actor_epsilon})
+                summary_str = sess.run(tf.summary.merge_all())
+                writer.add_summary(summary_str, ep)
+                print('Episode %2i, Reward: %7.3f, Steps: %i, Actor: %i, Updates: %i, Minutes: %7.3f'%\
+                    (ep, total_reward, steps_in_ep, actor_id, num_updates, (time.time() - start_time)/60))
+                ep += 1
+
+            if len(fleet.replay) < minibatch_size:
+                time.sleep(0.1)
+                continue
+
+            # update the slow target's weights to match the latest q network if it's time to do so
+            if num_updates%update_slow_target_every == 0:
+                _ = sess.run(update_slow_target_op)
+
+            minibatch = fleet.replay.sample(minibatch_size)
+            _ = sess.run(train_op,
+                feed_dict = {
+                    state_ph: minibatch[0],
+                    action_ph: minibatch[1],
+                    reward_ph: minibatch[2],
+                    next_state_ph: minibatch[3],
+                    is_not_terminal_ph: minibatch[4],
+                    is_training_ph: True})
+            num_updates += 1
+
+            if num_updates%publish_weights_every == 0:
+                fleet.publishWeights(sess.run(q_network_vars))
+
+        fleet.stop()
+        saver.save(sess, os.getcwd() + '/' + timestamp + ".ckpt")
+    elif args.model == '':
         #####################################################################################################
         ## Training
         print "Training a new model."
@@ -154,6 +238,11 @@ def main():
 
         total_steps = 0
         experience = deque(maxlen=replay_memory_capacity)
+        scheduler = ReplayRatioScheduler(minibatch_size, lr, train_every, \
+            scales = [1, 2, 4, 8] if args.schedule_batch else [1])
+
+        recorder = TrajectoryRecorder(args.record, state_dim, max_steps_ep, args.record_every) \
+            if args.record != '' else None
 
         epsilon = epsilon_start
         epsilon_linear_step = (epsilon_start-epsilon_end)/epsilon_decay_length
@@ -163,6 +252,8 @@ def main():
             steps_in_ep = 0
 
             observation = env.reset()
+            if recorder != None:
+                recorder.startEpisode(ep, observation)
 
             for t in range(max_steps_ep):
 
@@ -178,6 +269,8 @@ def main():
                 next_observation, reward, done, _info = env.step(action)
                 if args.visualize:
                     env.render()
+                if recorder != None:
+                    recorder.step(action, reward, global_idx, next_observation)
                 total_reward += reward
 
                 # add this to experience replay buffer
@@ -188,10 +281,12 @@ def main():
                     _ = sess.run(update_slow_target_op)
 
                 # update network weights to fit a minibatch of experience
-                if total_steps%train_every == 0 and len(experience) >= minibatch_size:
+                if scheduler.shouldUpdate(total_steps, len(experience)):
+                    update_start_time = time.time()
+                    scale = scheduler.scaleFor(len(experience))
 
                     # grab N (s,a,r,s') tuples from experience
-                    minibatch = random.sample(experience, minibatch_size)
+                    minibatch = random.sample(experience, scheduler.batchSize(scale))
 
                     # do a train_op with all the inputs required
                     _ = sess.run(train_op,
@@ -201,7 +296,9 @@ def main():
                             reward_ph: np.asarray([elem[2] for elem in minibatch]),
                             next_state_ph: np.asarray([elem[3] for elem in minibatch]),
                             is_not_terminal_ph: np.asarray([elem[4] for elem in minibatch]),
-                            is_training_ph: True})
+                            is_training_ph: True,
+                            lr_ph: scheduler.learningRate(scale)})
+                    scheduler.recordUpdate(time.time() - update_start_time, len(experience), scale)
 
                 observation = next_observation
                 total_steps += 1
@@ -222,6 +319,8 @@ def main():
                     _ = sess.run(episode_inc_op)
                     break
 
+            if recorder != None:
+                recorder.endEpisode()
             sess.run(update_ep_reward, feed_dict={r_summary_placeholder: total_reward})
             sess.run(update_plot_epsilon, feed_dict={eps_summary_placeholder: epsilon})
             summary_str = sess.run(tf.summary.merge_all())
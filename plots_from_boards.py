@@ -1,9 +1,7 @@
 # Matt Corsaro
 # Brown University CS 2951X Final Project
 # Skill chaining for continuous Lunar Lander
-from tensorboard.backend.event_processing import event_accumulator
 import numpy as np
-import matplotlib.pyplot as plt
 import time
 import datetime
 import os
@@ -13,6 +11,7 @@ import random
 import argparse
 
 def savePlot(rewards, color, filename):
+    import matplotlib.pyplot as plt
     plt.xlim([0, 1000])
     plt.ylim([-400, 400])
     avg = np.mean(rewards, axis=0)
@@ -26,6 +25,7 @@ def savePlot(rewards, color, filename):
     return (avg, smooth_average)
 
 def plotAll(averages, filename):
+    import matplotlib.pyplot as plt
     plt.xlim([0, 1000])
     plt.ylim([-400, 400])
     colors = [['b', 'aqua'], ["purple", "fuchsia"], ['r', 'm'], ['g', 'y']]
@@ -54,6 +54,9 @@ def main():
     parser.add_argument("--logdir", type=str, default="/home/matt/boards_ll")
     args = parser.parse_args()
 
+    # heavy import only once the arguments are parsed, so --help stays fast
+    from tensorboard.backend.event_processing import event_accumulator
+
     paths = []
     paths.append(args.logdir + '/' + "dqn" + '/')
     paths.append(args.logdir + '/' + "sc_load_dqn" + '/')
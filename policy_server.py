@@ -0,0 +1,197 @@
+# Matt Corsaro
+# Brown University CS 2951X Final Project
+# Skill chaining for continuous Lunar Lander
+# Local policy service: loads a trained DQN checkpoint or skill tree once and answers action queries from many client
+# processes over a Unix socket. Requests arriving close together are answered with one batched forward pass.
+import numpy as np
+
+import time
+import os
+import sys
+import threading
+import Queue
+from multiprocessing.connection import Listener, Client
+
+import argparse
+
+from actors import forward
+from skilltree import global_idx, loadSkillTree
+
+def loadDQNCheckpoint(model_file):
+    # Q network weights of a lunarlander.py checkpoint, in generate_network's layer order
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(model_file)
+    weights = []
+    for layer in ['dense', 'dense_1', 'dense_2', 'dense_3']:
+        weights.append(reader.get_tensor('q_network/' + layer + '/kernel'))
+        weights.append(reader.get_tensor('q_network/' + layer + '/bias'))
+    return weights
+
+# Per-connection state: the option a skill tree client is currently following
+class ClientState(object):
+    def __init__(self):
+        self.opt = global_idx
+
+class Request(object):
+    def __init__(self, client, observation, episode_start):
+        self.client = client
+        self.observation = np.asarray(observation, dtype=np.float32)
+        self.episode_start = episode_start
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.action = None
+
+class PolicyServer(object):
+    def __init__(self, address, weights, tree = None, max_batch = 64, max_delay = 0.002):
+        self.weights = weights
+        # skill tree, None when serving a plain DQN
+        self.tree = tree
+        self.max_batch = max_batch
+        # how long the first request of a batch waits for others to join it
+        self.max_delay = max_delay
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        self.resetMetrics()
+        if os.path.exists(address):
+            os.remove(address)
+        self.listener = Listener(address, family='AF_UNIX')
+
+    def resetMetrics(self):
+        with self.lock:
+            self.num_requests = 0
+            self.num_batches = 0
+            self.max_queue = 0
+            self.latencies = []
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) if len(self.latencies) != 0 else np.zeros(1)
+            return {'requests': self.num_requests, 'batches': self.num_batches, \
+                'mean batch': self.num_requests/float(max(self.num_batches, 1)), 'queue': self.requests.qsize(), \
+                'max queue': self.max_queue, 'latency ms p50': 1e3*np.percentile(latencies, 50), \
+                'latency ms p99': 1e3*np.percentile(latencies, 99)}
+
+    def serve(self, report_every):
+        batcher = threading.Thread(target=self.runBatches)
+        batcher.daemon = True
+        batcher.start()
+        acceptor = threading.Thread(target=self.accept)
+        acceptor.daemon = True
+        acceptor.start()
+        print "Serving on", self.listener.address
+        while True:
+            time.sleep(report_every)
+            metrics = self.metrics()
+            self.resetMetrics()
+            print ', '.join('%s: %.2f'%(name, value) for name, value in sorted(metrics.items()))
+
+    def accept(self):
+        while True:
+            conn = self.listener.accept()
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        client = ClientState()
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, IOError):
+                break
+            if message[0] == 'act':
+                request = Request(client, message[1], message[2])
+                self.requests.put(request)
+                request.done.wait()
+                conn.send((request.action, client.opt))
+            elif message[0] == 'metrics':
+                conn.send(self.metrics())
+        conn.close()
+
+    def runBatches(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = batch[0].arrival + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(0, deadline - time.time())))
+                except Queue.Empty:
+                    break
+            with self.lock:
+                self.max_queue = max(self.max_queue, self.requests.qsize() + len(batch))
+            self.answer(batch)
+            now = time.time()
+            with self.lock:
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.latencies += [now - request.arrival for request in batch]
+            for request in batch:
+                request.done.set()
+
+    def answer(self, batch):
+        states = np.array([request.observation for request in batch])
+        if self.tree is None:
+            actions = np.argmax(forward(self.weights, states), axis=1)
+        else:
+            # option dispatch for the whole batch from one initiation query, as in skillchain_lunarlander.py: leave an
+            # option once its termination set is reached, and from the global MDP follow the first option whose
+            # initiation set contains the state
+            in_init = self.tree.init_index.query(states[:, :2])
+            opts = np.zeros(len(batch), dtype=int)
+            for i, request in enumerate(batch):
+                client = request.client
+                if request.episode_start:
+                    client.opt = global_idx
+                # the goal option only terminates at the end of an episode, when no more actions are asked for
+                elif client.opt != global_idx and self.tree.parents[client.opt] != global_idx and \
+                        in_init[i, self.tree.parents[client.opt]]:
+                    client.opt = self.tree.parents[client.opt]
+                if client.opt == global_idx:
+                    client.opt = self.tree.firstOption(in_init[i])
+                opts[i] = client.opt
+            # one forward pass per option present in the batch
+            actions = np.zeros(len(batch), dtype=int)
+            for opt in np.unique(opts):
+                rows = np.nonzero(opts == opt)[0]
+                actions[rows] = np.argmax(forward([w[opt] for w in self.weights], states[rows]), axis=1)
+        for request, action in zip(batch, actions):
+            request.action = int(action)
+
+# For simulators: one connection per process, ask for an action every step
+class PolicyClient(object):
+    def __init__(self, address):
+        self.conn = Client(address, family='AF_UNIX')
+
+    def act(self, observation, episode_start = False):
+        # (action, index of the option that chose it)
+        self.conn.send(('act', observation, episode_start))
+        return self.conn.recv()
+
+    def metrics(self):
+        self.conn.send(('metrics',))
+        return self.conn.recv()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Lunar Lander policy server")
+    parser.add_argument("--model", type=str, default="", help="DQN checkpoint saved by lunarlander.py")
+    parser.add_argument("--skill-tree", type=str, default="", help="skill tree saved by skillchain_lunarlander.py")
+    parser.add_argument("--socket", type=str, default="/tmp/lunarlander_policy.sock")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-delay-ms", type=float, default=2.)
+    parser.add_argument("--report-every", type=float, default=10., help="seconds between metrics reports")
+    args = parser.parse_args()
+
+    if (args.model == '') == (args.skill_tree == ''):
+        parser.error("give one of --model and --skill-tree")
+    if args.model != '':
+        print "Loading trained model from", args.model
+        weights, tree = loadDQNCheckpoint(args.model), None
+    else:
+        print "Loading skill tree from", args.skill_tree
+        weights, tree, names = loadSkillTree(args.skill_tree)
+        print "Options:", ', '.join(names[idx] for idx in sorted(names))
+    server = PolicyServer(args.socket, weights, tree, args.max_batch, args.max_delay_ms/1e3)
+    server.serve(args.report_every)
+
+if __name__ == '__main__':
+    main()
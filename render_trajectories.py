@@ -0,0 +1,142 @@
+# Matt Corsaro
+# Brown University CS 2951X Final Project
+# Skill chaining for continuous Lunar Lander
+# Offline rendering of episodes recorded with --record: a summary image of the whole trajectory, or a video of it, with
+# the acting option and its initiation region overlaid. Needs no display and no environment.
+import numpy as np
+import matplotlib
+# before anything imports pyplot, so rendering works without a display whatever the default backend
+matplotlib.use('Agg')
+
+import os
+import sys
+
+import argparse
+
+from skilltree import global_idx
+from trajectories import recordedEpisodes, loadEpisode
+
+# Plotted area, in state coordinates (the landing pad is at y = 0 between x = -0.2 and x = 0.2)
+x_range = (-1., 1.)
+y_range = (-1./3, 1.5)
+# Lander outline in state coordinates, before rotating by its angle
+lander_outline = np.array([[-0.045, 0.], [0.045, 0.], [0.05, 0.05], [0.02, 0.09], [-0.02, 0.09], [-0.05, 0.05]])
+option_colors = ['k', 'b', 'r', 'g', 'm', 'c', 'y', 'orange', 'purple', 'brown']
+# Grid points classified per query, the query holds [points, support vectors] arrays
+region_chunk = 2000
+
+def optionColor(opt):
+    return option_colors[opt%len(option_colors)]
+
+def optionName(opt, names):
+    if names != None and opt in names:
+        return names[opt]
+    return "global MDP" if opt == global_idx else "option " + str(opt)
+
+def initiationRegions(tree, xx, yy):
+    # [num_opts, rows, cols] boolean: which grid points are in each trained initiation set
+    points = np.c_[xx.ravel(), yy.ravel()]
+    in_init = np.concatenate([tree.init_index.query(points[start:start + region_chunk]) \
+        for start in range(0, len(points), region_chunk)])
+    return np.transpose(in_init).reshape((-1,) + xx.shape)
+
+def landerPolygon(state):
+    angle = state[4]
+    rotation = np.array([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]])
+    return lander_outline.dot(rotation) + state[:2]
+
+def setupAxes(ax):
+    ax.set_xlim(x_range)
+    ax.set_ylim(y_range)
+    ax.set_xticks(())
+    ax.set_yticks(())
+    ax.plot([-0.2, 0.2], [0, 0], 'k-', linewidth=3)
+
+def saveSummary(trajectory, tree, names, filename):
+    # Whole trajectory colored by acting option, over the boundary of every initiation set used in it
+    import matplotlib.pyplot as plt
+    states, options = trajectory['states'], trajectory['options']
+    fig, ax = plt.subplots(1, 1)
+    setupAxes(ax)
+    used = np.unique(options)
+    if tree != None:
+        xx, yy = np.meshgrid(np.linspace(x_range[0], x_range[1], 200), np.linspace(y_range[0], y_range[1], 200))
+        regions = initiationRegions(tree, xx, yy)
+        for opt in used:
+            if opt != global_idx and regions[opt].any():
+                ax.contourf(xx, yy, regions[opt], levels=[0.5, 1.5], colors=[optionColor(opt)], alpha=0.15)
+                ax.contour(xx, yy, regions[opt], levels=[0.5], colors=[optionColor(opt)])
+    for opt in used:
+        steps = np.nonzero(options == opt)[0]
+        ax.scatter(states[steps, 0], states[steps, 1], s=4, c=optionColor(opt), label=optionName(opt, names))
+    ax.add_patch(plt.Polygon(landerPolygon(states[-1]), closed=True, color='gray'))
+    ax.legend(loc='upper right', fontsize='small')
+    ax.set_xlabel('Episode %i, %i steps, reward %.1f'%(trajectory['episode'], len(options), \
+        np.sum(trajectory['rewards'])))
+    plt.savefig(filename)
+    plt.close()
+
+def saveVideo(trajectory, tree, names, filename, stride, fps):
+    # One frame every stride steps: the trajectory so far, the lander, and the acting option's initiation region
+    import matplotlib.pyplot as plt
+    from matplotlib import animation
+    states, options, rewards = trajectory['states'], trajectory['options'], trajectory['rewards']
+    fig, ax = plt.subplots(1, 1)
+    setupAxes(ax)
+    xx, yy = np.meshgrid(np.linspace(x_range[0], x_range[1], 100), np.linspace(y_range[0], y_range[1], 100))
+    regions = initiationRegions(tree, xx, yy).astype(float) if tree != None else None
+    region_image = ax.imshow(np.zeros(xx.shape), extent=x_range + y_range, origin='lower', aspect='auto', \
+        cmap=plt.cm.Blues, vmin=0, vmax=3)
+    path_line, = ax.plot([], [], 'k-', linewidth=1)
+    lander = plt.Polygon(landerPolygon(states[0]), closed=True, color='gray')
+    ax.add_patch(lander)
+    label = ax.text(0.02, 0.96, '', transform=ax.transAxes, verticalalignment='top')
+    returns = np.concatenate([[0.], np.cumsum(rewards)])
+    frames = list(range(0, len(options), stride)) + [len(options)]
+
+    def drawFrame(t):
+        # the option acting at step t, the one that finished the episode on the last frame
+        opt = options[min(t, len(options) - 1)] if len(options) != 0 else global_idx
+        if tree != None and opt != global_idx:
+            region_image.set_data(regions[opt])
+        else:
+            region_image.set_data(np.zeros(xx.shape))
+        path_line.set_data(states[:t + 1, 0], states[:t + 1, 1])
+        lander.set_xy(landerPolygon(states[t]))
+        lander.set_color(optionColor(opt))
+        label.set_text('Episode %i, step %i, return %.1f\n%s'%(trajectory['episode'], t, returns[t], \
+            optionName(opt, names)))
+        return region_image, path_line, lander, label
+
+    anim = animation.FuncAnimation(fig, drawFrame, frames=frames, blit=True)
+    # .gif needs imagemagick, other formats ffmpeg
+    anim.save(filename, fps=fps, writer='imagemagick' if filename.endswith('.gif') else 'ffmpeg')
+    plt.close()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Render recorded Lunar Lander episodes")
+    parser.add_argument("directory", type=str, help="directory given to --record")
+    parser.add_argument("--episodes", type=int, nargs='*', default=[], help="episodes to render, default all recorded")
+    parser.add_argument("--output", type=str, default="", help="directory for the renders, default the recordings'")
+    parser.add_argument("--format", type=str, default="png", choices=["png", "mp4", "gif"], \
+        help="png for a summary image, mp4 or gif for a video")
+    parser.add_argument("--stride", type=int, default=2, help="steps per video frame")
+    parser.add_argument("--fps", type=int, default=25)
+    args = parser.parse_args()
+
+    episodes = args.episodes if len(args.episodes) != 0 else recordedEpisodes(args.directory)
+    output = args.output if args.output != '' else args.directory
+    if not os.path.exists(output):
+        os.makedirs(output)
+    trees = {}
+    for ep in episodes:
+        trajectory, tree, names = loadEpisode(args.directory, ep, trees)
+        filename = os.path.join(output, 'episode_%05i.%s'%(ep, args.format))
+        if args.format == 'png':
+            saveSummary(trajectory, tree, names, filename)
+        else:
+            saveVideo(trajectory, tree, names, filename, args.stride, args.fps)
+        print "Rendered episode", ep, "to", filename
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Matt Corsaro
+# Brown University CS 2951X Final Project
+# Skill chaining for continuous Lunar Lander
+# Trades the number of DQN updates against their batch size at a constant replay ratio (sampled transitions per
+# environment step): scale k means a batch k times larger every k times as many steps, with the learning rate scaled
+# by sqrt(k). The scale that costs the least update time per environment step on this machine is measured and used.
+# A replay too small for the chosen scale's batches keeps updating at the base scale.
+import numpy as np
+
+class ReplayRatioScheduler(object):
+    def __init__(self, base_batch_size, base_lr, base_interval = 1, scales = (1, 2, 4, 8), measure_updates = 50, \
+            reevaluate_every = 2000, min_replay_multiple = 10):
+        self.base_batch_size = base_batch_size
+        self.base_lr = base_lr
+        # transitions added to the replay between updates at scale 1
+        self.base_interval = base_interval
+        self.scales = list(scales)
+        # updates timed for each scale before choosing one
+        self.measure_updates = measure_updates
+        # updates at the chosen scale before measuring again
+        self.reevaluate_every = reevaluate_every
+        # a scale is only used once the replay holds this many of its batches
+        self.min_replay_multiple = min_replay_multiple
+        self.scale = self.scales[0]
+        self.update_times = {}
+        # nothing to measure with a single scale
+        self.measuring = len(self.scales) > 1
+        self.updates_at_scale = 0
+
+    def batchSize(self, scale = None):
+        return self.base_batch_size*(scale or self.scale)
+
+    def learningRate(self, scale = None):
+        return self.base_lr*np.sqrt(scale or self.scale)
+
+    def scaleFor(self, replay_size):
+        # scale to update a replay of this size at
+        return self.scale if self.batchSize() <= replay_size else self.scales[0]
+
+    def shouldUpdate(self, num_added, replay_size):
+        # num_added: transitions added to the replay being updated before the latest one
+        scale = self.scaleFor(replay_size)
+        return num_added%(self.base_interval*scale) == 0 and replay_size >= self.batchSize(scale)
+
+    def allowedScales(self, replay_size):
+        return [scale for scale in self.scales if scale == self.scales[0] or \
+            self.base_batch_size*scale*self.min_replay_multiple <= replay_size]
+
+    def recordUpdate(self, seconds, replay_size, scale = None):
+        # seconds one update (sampling included) took at the given scale, by default the current one
+        scale = scale or self.scale
+        if scale != self.scale:
+            # queued before the last switch, or a replay too small for the current scale
+            if self.measuring:
+                self.update_times.setdefault(scale, []).append(seconds)
+            return
+        self.updates_at_scale += 1
+        if not self.measuring:
+            if len(self.scales) > 1 and self.updates_at_scale >= self.reevaluate_every:
+                self.measuring = True
+                self.update_times = {}
+                self.switchScale(self.scales[0])
+            return
+        self.update_times.setdefault(self.scale, []).append(seconds)
+        if self.updates_at_scale < self.measure_updates:
+            return
+        unmeasured = [scale for scale in self.allowedScales(replay_size) \
+            if len(self.update_times.get(scale, [])) < self.measure_updates]
+        if len(unmeasured) != 0:
+            self.switchScale(unmeasured[0])
+        else:
+            # update time per environment step
+            cost = dict((scale, np.median(times)/scale) for scale, times in self.update_times.items())
+            self.measuring = False
+            self.switchScale(min(cost, key=cost.get))
+            print "Batch schedule: using batch size", self.batchSize(), "every", self.base_interval*self.scale, \
+                "steps, update ms per step by scale:", \
+                ', '.join('%i: %.2f'%(scale, 1e3*cost[scale]) for scale in sorted(cost))
+
+    def switchScale(self, scale):
+        self.scale = scale
+        self.updates_at_scale = 0
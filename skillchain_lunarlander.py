@@ -4,11 +4,6 @@
 # Original DQN code from:
 # https://gist.github.com/heerad/d2b92c2f3a83b5e4be395546c17b274c#file-dqn-lunarlander-v2-py
 import numpy as np
-import gym
-from gym import wrappers
-import tensorflow as tf
-from sklearn import svm
-import matplotlib.pyplot as plt
 
 import time
 import datetime
@@ -16,8 +11,14 @@ import os
 from os import path
 import sys
 import random
+import multiprocessing
 from collections import deque
-from anytree import NodeMixin, RenderTree
+
+from skilltree import atGoal, global_idx, InitiationExampleStore, InitiationSetIndex, InitiationMasks, TreeSnapshot, \
+    saveSkillTree
+from actors import ActorFleet
+from replay_schedule import ReplayRatioScheduler
+from trajectories import TrajectoryRecorder
 
 import argparse
 
@@ -47,33 +48,99 @@ epsilon_decay_exp = 0.98
 # Skill chain params
 # don't execute after creating, off-policy learning
 gestation = 10
-# Stop adding options after this timestep
-add_opt_cutoff = num_episodes/5
 # Maximum number of steps in one option
 max_steps_opt = 25
-max_neg_traj = max_steps_opt*10
 # Option completion reward - not used since global MDP currently must choose an option if presented with it
 opt_r = 35
 # How long to gather initiation classifier data for, and the maximum number of examples that can be reached before
 num_ep_init_class = 50
 max_num_init_ex = 6000
+# Initiation classifiers are fit on a class-balanced reservoir sample of at most this many examples
+max_fit_examples = 4000
+# Examples closer than this (same grid cell) to a stored example with the same label are dropped
+init_example_resolution = 0.005
+# Processes fitting initiation classifiers in the background
+classifier_fit_workers = 2
 # unused
 max_branching_factor = 2
-# episode to drop the epsilon to 0
-epsilon_drop_episode = 4*num_episodes/5
-
-def atGoal(state, done):
-    # If landed in the target zone (between the two flags)
-    x = state[0]
-    y = state[1]
-    return -0.2 < x < 0.2 and -0.1 < y < 0.1 and done
+# Global transitions reclassified per training step for an option whose initiation classifier changed
+off_policy_rescore_chunk = 256
+# With --actors, room in the shared-memory replay for actor transitions not yet read into the options' experience
+actor_replay_capacity = int(1e5)
+# Learner steps between publishing the option networks to the actors
+publish_weights_every = 400
+# Bytes the replay, initiation and bookkeeping buffers of the whole option tree may take before the least executed
+# options that are done gestating have their buffers shrunk
+memory_budget = int(16e9)
+
+# Constants computed from the ones above, in this order
+derived_params = [
+    # Stop adding options after this timestep
+    ('add_opt_cutoff', lambda: num_episodes/5),
+    # Negative initiation examples taken from the end of a trajectory, before its last max_steps_opt steps
+    ('max_neg_traj', lambda: max_steps_opt*10),
+    # A new option is only created once the previous one's initiation classifier is done training, which takes at
+    # least this many episodes: num_ep_init_class have passed, or enough examples were offered (at most max_steps_opt
+    # positive and max_neg_traj negative ones per episode)
+    ('min_episodes_per_option', \
+        lambda: min(num_ep_init_class + 1, max_num_init_ex//(max_steps_opt + max_neg_traj) + 1)),
+    # Number of networks the stacked option weights have room for: the global MDP, the goal option and every option
+    # that can be created before add_opt_cutoff
+    ('max_num_opts', lambda: 2 + (add_opt_cutoff - 1)//min_episodes_per_option),
+    # Options also learn off-policy from global transitions that start in their initiation sets. Each step the global
+    # MDP trains, this many replay rows are drawn and filtered by the initiation bits stored with each transition
+    ('off_policy_sample_size', lambda: minibatch_size*4),
+    # Minimum number of matching transitions in that batch for an option to get an off-policy update
+    ('off_policy_min_matches', lambda: minibatch_size/8),
+    # Replay buffers are never shrunk below this many transitions
+    ('min_replay_evicted', lambda: minibatch_size),
+    # episode to drop the epsilon to 0
+    ('epsilon_drop_episode', lambda: 4*num_episodes/5),
+]
+
+def deriveParams(overridden = ()):
+    for name, derive in derived_params:
+        if name not in overridden:
+            globals()[name] = derive()
+
+deriveParams()
+
+# Replace module-level constants with values given as NAME=VALUE strings, e.g. from hyperparam_search.py. Constants
+# derived from others (add_opt_cutoff, max_neg_traj, ...) are recomputed unless overridden themselves.
+def overrideParams(params):
+    overridden = []
+    for param in params:
+        name, value = param.split('=', 1)
+        if name not in globals() or not isinstance(globals()[name], (int, float)):
+            raise ValueError("Unknown parameter " + name)
+        globals()[name] = type(globals()[name])(value)
+        overridden.append(name)
+        print "Overriding", name, "with", globals()[name]
+    before = dict((name, globals()[name]) for name, _derive in derived_params)
+    deriveParams(overridden)
+    for name, _derive in derived_params:
+        if globals()[name] != before[name]:
+            print "Deriving", name, "=", globals()[name]
 
 def getMinibatchElem(minibatch, i):
     return np.asarray([elem[i] for elem in minibatch])
 
+def getStackedMinibatchElem(minibatches, i):
+    return np.stack([getMinibatchElem(minibatch, i) for minibatch in minibatches])
+
 def statesFromExperiences(experiences):
     return [example[0][:2] for example in experiences]
 
+# Bytes of a replay slot, a pointer to the transition
+replay_slot_bytes = 8
+
+# Approximate bytes taken by one transition: the tuple and its elements
+def experienceBytes(experience):
+    return sys.getsizeof(experience) + sum(sys.getsizeof(elem) for elem in experience)
+
+def megabytes(num_bytes):
+    return num_bytes/float(2**20)
+
 def make_meshgrid(x_min, x_max, y_min, y_max, h=.02):
     xx, yy = np.meshgrid(np.arange(x_min, x_max, h), np.arange(y_min, y_max, h))
     return xx, yy
@@ -94,6 +161,47 @@ def plot_contours(ax, clf, xx, yy, **params):
     out = ax.contourf(xx, yy, Z, **params)
     return out
 
+def saveInitiationPlot(classifier, examples, example_labels, n, directory, ep):
+    import matplotlib.pyplot as plt
+    num_pos_examples = np.sum(example_labels == 1)
+    num_neg_examples = np.sum(example_labels == 0)
+    try:
+        # very rarely, the legend doesn't fit correctly, and this fails
+        # http://scikit-learn.org/stable/auto_examples/svm/plot_iris.html
+        X0, X1 = examples[:, 0], examples[:, 1]
+        xx, yy = make_meshgrid(-1, 1, -1./3, 1)
+        labels = [str(num_pos_examples) + " positive examples", str(num_neg_examples) + " negative examples"]
+
+        fig, sub = plt.subplots(1, 1)
+
+        plot_contours(sub, classifier, xx, yy, cmap=plt.cm.coolwarm, alpha=0.8)
+        sub.scatter(X0, X1, c=example_labels, cmap=plt.cm.coolwarm, s=20, edgecolors='k')
+        sub.set_xlim(xx.min(), xx.max())
+        sub.set_ylim(yy.min(), yy.max())
+        sub.set_xticks(())
+        sub.set_yticks(())
+        sub.set_xlabel("Option " + str(n) + " at episode " + str(ep))
+        sub.set_ylabel(str(num_pos_examples) + " pos, " + str(num_neg_examples) + " neg")
+
+        #sub.legend(labels=labels, bbox_to_anchor=(0., 1.02, 1., .102), loc=3, ncol=2, mode="expand", borderaxespad=0.)
+        plt.plot([-0.2, 0.2], [0, 0], 'k-')
+        plt.savefig(directory + '/' + str(ep) + '.png')
+
+        plt.close()
+    except:
+        print "Failed to generate plot for option", n, " at episode", ep
+        print sys.exc_info()[0]
+
+# Runs in a classifier worker process, so the episode loop never waits on a fit
+def fitInitiationClassifier(fit_examples, fit_labels, examples, example_labels, n, directory, ep):
+    from sklearn import svm
+    class_start_time = time.time()
+    classifier = svm.SVC(kernel="rbf")
+    classifier.fit(fit_examples, fit_labels)
+    fit_time = time.time() - class_start_time
+    saveInitiationPlot(classifier, examples, example_labels, n, directory, ep)
+    return classifier, fit_time
+
 # TODO: BFS function...
 def optTreeToList(root_option):
     optList = []
@@ -104,13 +212,15 @@ def optTreeToList(root_option):
         queue += opt.children
     return optList
 
-def findOptForState(position, root_option, ep):
+def findOptForState(position, root_option, ep, init_index):
+    # the state classified against every initiation set at once
+    in_init = init_index.query([position])[0]
     # BFS Search
     queue = [root_option]
     while len(queue) != 0:
         opt = queue.pop(0)
         # If the state is in the initation set and the initiation set classifier has been fully trained
-        if opt.inInitiationSet(position) and opt.classifierTrained():
+        if opt.initTrained and in_init[opt.idx] and opt.classifierTrained():
             return opt
         else:
             queue += opt.children
@@ -138,8 +248,34 @@ def main():
     parser.add_argument('--visualize', dest='visualize', action='store_true')
     parser.add_argument('--no-visualize', dest='visualize', action='store_false')
     parser.set_defaults(visualize=False)
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE', \
+        help="override a module-level parameter, may be repeated")
+    # Distributed collection: actor processes step their own environments with the current option tree
+    parser.add_argument("--actors", type=int, default=0, help="number of local actor processes")
+    parser.add_argument("--listen", type=str, default="", help="host:port to accept remote actors (actors.py) on")
+    parser.add_argument("--authkey", type=str, default="", \
+        help="secret remote actors connect with, generated and printed if not given")
+    parser.add_argument("--total-actors", type=int, default=0, \
+        help="actors on all nodes, for the per-actor epsilons, default --actors")
+    parser.add_argument("--record", type=str, default="", \
+        help="directory to record episodes to, for render_trajectories.py")
+    parser.add_argument("--record-every", type=int, default=1, help="record every this many episodes")
+    parser.add_argument('--schedule-batch', dest='schedule_batch', action='store_true', \
+        help="trade update count against batch size based on measured update times")
+    parser.set_defaults(schedule_batch=False)
     args = parser.parse_args()
 
+    try:
+        overrideParams(args.param)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # heavy imports only once the arguments are parsed, so --help stays fast
+    import gym
+    import tensorflow as tf
+    from sklearn import svm
+    from anytree import NodeMixin
+
     # game parameters
     env = gym.make("LunarLander-v2")
     state_dim = np.prod(np.array(env.observation_space.shape))
@@ -150,13 +286,20 @@ def main():
 
     tf.reset_default_graph()
 
+    # Every option's network is stored as one slice of stacked weight tensors with a leading option dimension (index 0
+    # is the global MDP). The networks of several options are evaluated and trained together with batched matmuls over
+    # the slices selected by opt_idx_ph, so one session call can update every option that has pending updates.
+    layer_sizes = [int(state_dim), h1, h2, h3, n_actions]
+
     # placeholders
-    state_ph = tf.placeholder(dtype=tf.float32, shape=[None,state_dim]) # input to Q network
-    next_state_ph = tf.placeholder(dtype=tf.float32, shape=[None,state_dim]) # input to slow target network
-    action_ph = tf.placeholder(dtype=tf.int32, shape=[None]) # action indices (indices of Q network output)
-    reward_ph = tf.placeholder(dtype=tf.float32, shape=[None]) # rewards (go into target computation)
-    is_not_terminal_ph = tf.placeholder(dtype=tf.float32, shape=[None]) # indicators (go into target computation)
+    opt_idx_ph = tf.placeholder(dtype=tf.int32, shape=[None]) # indices of the options to run (leading dim below)
+    state_ph = tf.placeholder(dtype=tf.float32, shape=[None,None,state_dim]) # input to Q network
+    next_state_ph = tf.placeholder(dtype=tf.float32, shape=[None,None,state_dim]) # input to slow target network
+    action_ph = tf.placeholder(dtype=tf.int32, shape=[None,None]) # action indices (indices of Q network output)
+    reward_ph = tf.placeholder(dtype=tf.float32, shape=[None,None]) # rewards (go into target computation)
+    is_not_terminal_ph = tf.placeholder(dtype=tf.float32, shape=[None,None]) # indicators (go into target computation)
     is_training_ph = tf.placeholder(dtype=tf.bool, shape=()) # for dropout
+    lr_ph = tf.placeholder_with_default(float(lr), shape=()) # learning rate, scaled with the batch size
 
     episode_reward = tf.Variable(0.)
     tf.summary.scalar("Episode Reward", episode_reward)
@@ -168,62 +311,132 @@ def main():
     eps_summary_placeholder = tf.placeholder("float")
     update_plot_epsilon = plot_epsilon.assign(eps_summary_placeholder)
 
-    # episode counter
-    episodes = tf.Variable(0.0, trainable=False, name='episodes')
-    episode_inc_op = episodes.assign_add(1)
-
-    # will use this to initialize both Q network and slowly-changing target network with same structure
-    def generate_network(s, trainable, reuse):
-        hidden = tf.layers.dense(s, h1, activation = tf.nn.relu, trainable = trainable, name = 'dense', reuse = reuse)
-        hidden_drop = tf.layers.dropout(hidden, rate = dropout, training = trainable & is_training_ph)
-        hidden_2 = tf.layers.dense(hidden_drop, h2, activation = tf.nn.relu, trainable = trainable, name = 'dense_1', \
-            reuse = reuse)
-        hidden_drop_2 = tf.layers.dropout(hidden_2, rate = dropout, training = trainable & is_training_ph)
-        hidden_3 = tf.layers.dense(hidden_drop_2, h3, activation = tf.nn.relu, trainable = trainable, name = 'dense_2',\
-            reuse = reuse)
-        hidden_drop_3 = tf.layers.dropout(hidden_3, rate = dropout, training = trainable & is_training_ph)
-        action_values = tf.squeeze(tf.layers.dense(hidden_drop_3, n_actions, trainable = trainable, name = 'dense_3', \
-            reuse = reuse))
-        return action_values
-
-    with tf.variable_scope('q_network') as scope:
-        # Q network applied to state_ph
-        q_action_values = generate_network(state_ph, trainable = True, reuse = False)
-        # Q network applied to next_state_ph (for double Q learning)
-        q_action_values_next = tf.stop_gradient(generate_network(next_state_ph, trainable = False, reuse = True))
-
+    merged_summary = tf.summary.merge_all()
+
+    # episode counter, one per option
+    episodes = tf.Variable(tf.zeros([max_num_opts]), trainable=False, name='episodes')
+    episode_inc_op = tf.scatter_add(episodes, opt_idx_ph, tf.ones_like(opt_idx_ph, dtype=tf.float32))
+
+    # kernel and bias variables for every layer, stacked over all options
+    def generate_stacked_weights(trainable):
+        weights = []
+        for i in range(len(layer_sizes) - 1):
+            n_in, n_out = layer_sizes[i], layer_sizes[i+1]
+            # Glorot uniform like tf.layers.dense, computed from the per-option shape and drawn separately per option
+            limit = np.sqrt(6. / (n_in + n_out))
+            weights.append(tf.Variable(tf.random_uniform([max_num_opts, n_in, n_out], -limit, limit), \
+                trainable = trainable, name = 'kernel_' + str(i)))
+            weights.append(tf.Variable(tf.zeros([max_num_opts, n_out]), trainable = trainable, name = 'bias_' + str(i)))
+        return weights
+
+    # will use this to evaluate both Q network and slowly-changing target network with same structure
+    # s: [options, batch, state_dim], weights: slices of the stacked weights for the same options
+    def generate_network(s, weights, trainable):
+        hidden = s
+        num_layers = len(weights)//2
+        for i in range(num_layers):
+            hidden = tf.matmul(hidden, weights[2*i]) + tf.expand_dims(weights[2*i + 1], 1)
+            if i < num_layers - 1:
+                hidden = tf.nn.relu(hidden)
+                hidden = tf.layers.dropout(hidden, rate = dropout, training = trainable & is_training_ph)
+        return hidden
+
+    with tf.variable_scope('q_network'):
+        q_network_vars = generate_stacked_weights(trainable = True)
     # slow target network
-    with tf.variable_scope('slow_target_network', reuse=False):
-        # use stop_gradient to treat the output values as constant targets when doing backprop
-        slow_target_action_values = tf.stop_gradient(generate_network(next_state_ph, trainable = False, reuse = False))
+    with tf.variable_scope('slow_target_network'):
+        slow_target_network_vars = generate_stacked_weights(trainable = False)
+
+    q_weights = [tf.gather(var, opt_idx_ph) for var in q_network_vars]
+    slow_target_weights = [tf.gather(var, opt_idx_ph) for var in slow_target_network_vars]
 
-    # isolate vars for each network
-    q_network_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='q_network')
-    slow_target_network_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='slow_target_network')
+    # Q network applied to state_ph
+    q_action_values = generate_network(state_ph, q_weights, trainable = True)
+    # Q network applied to next_state_ph (for double Q learning)
+    q_action_values_next = tf.stop_gradient(generate_network(next_state_ph, q_weights, trainable = False))
+    # use stop_gradient to treat the output values as constant targets when doing backprop
+    slow_target_action_values = tf.stop_gradient(generate_network(next_state_ph, slow_target_weights, \
+        trainable = False))
 
-    # update values for slowly-changing target network to match current critic network
+    # update values for slowly-changing target networks of the selected options to match their current critic networks
     update_slow_target_ops = []
-    for i, slow_target_var in enumerate(slow_target_network_vars):
-        update_slow_target_op = slow_target_var.assign(q_network_vars[i])
-        update_slow_target_ops.append(update_slow_target_op)
+    for slow_target_var, q_weight in zip(slow_target_network_vars, q_weights):
+        update_slow_target_ops.append(tf.scatter_update(slow_target_var, opt_idx_ph, q_weight))
 
     update_slow_target_op = tf.group(*update_slow_target_ops, name='update_slow_target')
 
-    targets = reward_ph + is_not_terminal_ph * gamma * \
-        tf.gather_nd(slow_target_action_values, tf.stack((tf.range(minibatch_size), \
-            tf.cast(tf.argmax(q_action_values_next, axis=1), tf.int32)), axis=1))
+    targets = reward_ph + is_not_terminal_ph * gamma * tf.reduce_sum(slow_target_action_values * \
+        tf.one_hot(tf.argmax(q_action_values_next, axis=2), n_actions), axis=2)
 
     # Estimated Q values for (s,a) from experience replay
-    estim_taken_action_vales = tf.gather_nd(q_action_values, tf.stack((tf.range(minibatch_size), action_ph), axis=1))
-
-    # loss function (with regularization)
-    loss = tf.reduce_mean(tf.square(targets - estim_taken_action_vales))
+    estim_taken_action_vales = tf.reduce_sum(q_action_values * tf.one_hot(action_ph, n_actions), axis=2)
+
+    # loss function (with regularization) for each option, summed so that every option gets the gradient it would get
+    # if trained alone
+    option_losses = tf.reduce_mean(tf.square(targets - estim_taken_action_vales), axis=1)
+    for i in range(0, len(q_weights), 2):
+        # per-option tf.nn.l2_loss of the kernels
+        option_losses += l2_reg * 0.5 * 0.5 * tf.reduce_sum(tf.square(q_weights[i]), axis=[1, 2])
+    loss = tf.reduce_sum(option_losses)
+
+    # optimizer: Adam with separate moments and step counts for every option, applied only to the selected slices so
+    # options without pending updates are left untouched
+    adam_beta1 = 0.9
+    adam_beta2 = 0.999
+    adam_epsilon = 1e-8
+    adam_steps = tf.Variable(tf.zeros([max_num_opts]), trainable=False, name='adam_steps')
+    adam_slot_vars = []
     for var in q_network_vars:
-        if not 'bias' in var.name:
-            loss += l2_reg * 0.5 * tf.nn.l2_loss(var)
-
-    # optimizer
-    train_op = tf.train.AdamOptimizer(lr*lr_decay**episodes).minimize(loss)
+        adam_slot_vars.append(tf.Variable(tf.zeros(var.get_shape()), trainable=False, name=var.op.name + '_adam_m'))
+        adam_slot_vars.append(tf.Variable(tf.zeros(var.get_shape()), trainable=False, name=var.op.name + '_adam_v'))
+    grads = tf.gradients(loss, q_weights)
+    # read the optimizer state only after the gradients have been computed from the current weights
+    with tf.control_dependencies(grads):
+        adam_t = tf.gather(adam_steps, opt_idx_ph) + 1
+        opt_lr = lr_ph * lr_decay**tf.gather(episodes, opt_idx_ph) * \
+            tf.sqrt(1 - adam_beta2**adam_t) / (1 - adam_beta1**adam_t)
+        train_ops = [tf.scatter_update(adam_steps, opt_idx_ph, adam_t)]
+        for i, (var, q_weight, grad) in enumerate(zip(q_network_vars, q_weights, grads)):
+            m, v = adam_slot_vars[2*i], adam_slot_vars[2*i + 1]
+            m_t = adam_beta1 * tf.gather(m, opt_idx_ph) + (1 - adam_beta1) * grad
+            v_t = adam_beta2 * tf.gather(v, opt_idx_ph) + (1 - adam_beta2) * tf.square(grad)
+            # broadcast each option's learning rate over its weight slice
+            step_size = tf.reshape(opt_lr, [-1] + [1]*(len(var.get_shape()) - 1))
+            train_ops.append(tf.scatter_update(m, opt_idx_ph, m_t))
+            train_ops.append(tf.scatter_update(v, opt_idx_ph, v_t))
+            train_ops.append(tf.scatter_update(var, opt_idx_ph, \
+                q_weight - step_size * m_t / (tf.sqrt(v_t) + adam_epsilon)))
+    train_op = tf.group(*train_ops, name='train')
+
+    # copy every per-option variable (weights, target weights, optimizer state, episode count) between two options
+    copy_src_ph = tf.placeholder(dtype=tf.int32, shape=[1])
+    copy_dst_ph = tf.placeholder(dtype=tf.int32, shape=[1])
+    copy_network_ops = []
+    for var in q_network_vars + slow_target_network_vars + adam_slot_vars + [adam_steps, episodes]:
+        copy_network_ops.append(tf.scatter_update(var, copy_dst_ph, tf.gather(var, copy_src_ph)))
+    copy_network_op = tf.group(*copy_network_ops, name='copy_network')
+
+    # actors and classifier workers have to be forked before the session is created
+    classifier_pool = multiprocessing.Pool(classifier_fit_workers)
+    fleet = None
+    if args.actors > 0 or args.listen:
+        fleet = ActorFleet(args.actors, "sc", state_dim, max_steps_ep, actor_replay_capacity, \
+            [var.get_shape().as_list() for var in q_network_vars], listen = args.listen, authkey = args.authkey, \
+            total_actors = args.total_actors or None)
+        fleet.start()
+
+    # a single session holds every option's network
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+
+    # batch size and update interval shared by every option, so their updates can be stacked
+    scheduler = ReplayRatioScheduler(minibatch_size, lr, train_every, \
+        scales = [1, 2, 4, 8] if args.schedule_batch else [1])
+
+    # every option's initiation classifier, for classifying batches of states against all options at once
+    init_index = InitiationSetIndex(max_num_opts)
+    # initiation sets the start state of each global MDP transition is in
+    replay_masks = InitiationMasks(replay_memory_capacity, init_index, off_policy_rescore_chunk)
 
     ## Tensorflow
     ####################################################################################################################
@@ -235,104 +448,174 @@ def main():
         def __init__(self, n, start_ep):
             self.n = n
             self.start_ep = start_ep
-
-            self.sess = tf.Session()
-            self.sess.run(tf.global_variables_initializer())
+            # slice of the stacked network weights, the global MDP comes first
+            self.idx = global_idx if n == "GlobalMDP" else n + 1
+            assert(self.idx < max_num_opts)
 
             self.writer = tf.summary.FileWriter("board_" + timestamp + '_' + str(n))
-            self.writer.add_graph(self.sess.graph)
-
-            self.saver = tf.train.Saver()
+            self.writer.add_graph(sess.graph)
 
             self.directory = timestamp + '/' + str(self.n)
             if not os.path.exists(self.directory):
                 os.makedirs(self.directory)
 
-            self.initiation_examples = []
-            self.initiation_labels = []
+            self.initiation_store = InitiationExampleStore(max_fit_examples, init_example_resolution)
             # Printing
             self.num_updates_per_ep = [0]*num_episodes
             self.size_exp_buff_per_ep = [0]*num_episodes
             self.initiation_classifier = svm.SVC(kernel="rbf")
 
             self.experience = deque(maxlen=replay_memory_capacity)
+            # transitions ever appended to the replay
+            self.num_appended = 0
+            # (global MDP's num_appended, own num_appended) at the end of past episodes: the transitions appended before
+            # a mark whose global count is behind the global replay's oldest transition are only held here
+            self.replay_marks = deque()
 
             self.initTrained = False
+            # AsyncResult of a classifier fit running in classifier_pool
+            self.pending_fit = None
+            self.refit_needed = False
+            # set once the initiation examples of a finished classifier have been evicted
+            self.initExamplesEvicted = False
 
             self.epsilon = epsilon_start
             self.epsilon_linear_step = (epsilon_start-epsilon_end)/epsilon_decay_length
             self.total_steps = 0
+            # calls to updateDQN, which gate this network's updates. Unlike total_steps, it also counts the steps the
+            # global MDP learns from while an option acts, and the steps a new option learns from when it is created.
+            self.num_update_calls = 0
+            # scale of each network update owed since the last call to trainPendingOptions
+            self.pending_scales = []
+            self.target_update_pending = False
 
         def writeReward(self, r, ep):
-            self.sess.run(update_ep_reward, feed_dict={r_summary_placeholder: r})
-            summary_str = self.sess.run(tf.summary.merge_all())
+            sess.run(update_ep_reward, feed_dict={r_summary_placeholder: r})
+            summary_str = sess.run(merged_summary)
             self.writer.add_summary(summary_str, ep)
 
         def writeEpsilon(self, ep):
-            self.sess.run(update_plot_epsilon, feed_dict={eps_summary_placeholder: self.epsilon})
+            sess.run(update_plot_epsilon, feed_dict={eps_summary_placeholder: self.epsilon})
             if self.n != "GlobalMDP":
-                summary_str = self.sess.run(tf.summary.merge_all())
+                summary_str = sess.run(merged_summary)
                 self.writer.add_summary(summary_str, ep)
 
         def retrainInitationClassifier(self, ep):
-            self.num_pos_examples = len([x for x in self.initiation_labels if x == 1])
-            self.num_neg_examples = len([x for x in self.initiation_labels if x == 0])
+            self.num_pos_examples = self.initiation_store.numPositive()
+            self.num_neg_examples = self.initiation_store.numNegative()
             if self.num_pos_examples != 0 and self.num_neg_examples != 0:
-                print "Training classifier with", len([x for x in self.initiation_labels if x == 1]), \
-                    "positive examples and", len([x for x in self.initiation_labels if x == 0]), "negative examples."
-                class_start_time = time.time()
-                self.initiation_classifier.fit(self.initiation_examples, self.initiation_labels)
-                print "Retrained option", self.n, "classifier in", (time.time() - class_start_time), "seconds."
-                self.saveInitiationPlot(ep)
-                self.initTrained = True
+                if self.pending_fit != None:
+                    # fit again with the examples added meanwhile once the running fit is done
+                    self.refit_needed = True
+                    return
+                fit_examples, fit_labels = self.initiation_store.fitExamples()
+                print "Training classifier with", np.sum(fit_labels == 1), "of", self.num_pos_examples, \
+                    "positive examples and", np.sum(fit_labels == 0), "of", self.num_neg_examples, "negative examples."
+                examples, example_labels = self.initiation_store.storedExamples()
+                self.pending_fit = classifier_pool.apply_async(fitInitiationClassifier, (fit_examples, fit_labels, \
+                    examples.copy(), example_labels.copy(), self.n, self.directory, ep))
+
+        def pollClassifierFit(self, ep):
+            # Swap in a classifier fit in the background once it's ready, the previous one stays in use until then.
+            # initTrained, the classifier and the initiation index all change together here, between steps.
+            if self.pending_fit == None or not self.pending_fit.ready():
+                return
+            classifier, fit_time = self.pending_fit.get()
+            self.pending_fit = None
+            print "Retrained option", self.n, "classifier in", fit_time, "seconds."
+            self.initiation_classifier = classifier
+            init_index.update(self.idx, self.initiation_classifier)
+            replay_masks.invalidate(self.idx)
+            self.initTrained = True
+            if self.refit_needed:
+                self.refit_needed = False
+                self.retrainInitationClassifier(ep)
 
         def classifierTrained(self):
-            return ep - self.start_ep > num_ep_init_class or len(self.initiation_labels) > max_num_init_ex
-
-        def loadDQNWeights(self, model_file):
-            print "Loading weights for new option", self.n, "from", model_file
-            self.saver.restore(self.sess, model_file)
-
-        def saveDQNWeights(self, model_file):
-            assert(self.n == "GlobalMDP")
-            print "Saving", self.n, "DQN weights to", model_file
-            self.saver.save(self.sess, model_file)
-
-        def saveInitiationPlot(self, ep):
-            try:
-                # very rarely, the legend doesn't fit correctly, and this fails
-                # http://scikit-learn.org/stable/auto_examples/svm/plot_iris.html
-                X0, X1 = np.array(self.initiation_examples)[:, 0], np.array(self.initiation_examples)[:, 1]
-                xx, yy = make_meshgrid(-1, 1, -1./3, 1)
-                labels = [str(self.num_pos_examples) + " positive examples", \
-                    str(self.num_neg_examples) + " negative examples"]
-
-                fig, sub = plt.subplots(1, 1)
-
-                plot_contours(sub, self.initiation_classifier, xx, yy, cmap=plt.cm.coolwarm, alpha=0.8)
-                sub.scatter(X0, X1, c=self.initiation_labels, cmap=plt.cm.coolwarm, s=20, edgecolors='k')
-                sub.set_xlim(xx.min(), xx.max())
-                sub.set_ylim(yy.min(), yy.max())
-                sub.set_xticks(())
-                sub.set_yticks(())
-                sub.set_xlabel("Option " + str(self.n) + " at episode " + str(ep))
-                sub.set_ylabel(str(self.num_pos_examples) + " pos, " + str(self.num_neg_examples) + " neg")
-
-                #sub.legend(labels=labels, bbox_to_anchor=(0., 1.02, 1., .102), loc=3, ncol=2, mode="expand", borderaxespad=0.)
-                plt.plot([-0.2, 0.2], [0, 0], 'k-')
-                plt.savefig(self.directory + '/' + str(ep) + '.png')
-
-                plt.close()
-            except:
-                print "Failed to generate plot for option", self.n, " at episode", ep
-                print sys.exc_info()[0]
+            return self.initExamplesEvicted or ep - self.start_ep > num_ep_init_class or \
+                self.initiation_store.num_offered > max_num_init_ex
+
+        def appendExperience(self, experience):
+            self.experience.append(experience)
+            self.num_appended += 1
+
+        def markReplay(self):
+            self.replay_marks.append((globalMDP.num_appended, self.num_appended))
+
+        def numOwnedTransitions(self):
+            # Option replays hold the same transitions as the global replay, except those it has dropped since. At
+            # least this many of the oldest transitions here are no longer in the global replay.
+            if self == globalMDP:
+                return len(self.experience)
+            global_oldest = globalMDP.num_appended - len(globalMDP.experience)
+            oldest = self.num_appended - len(self.experience)
+            while len(self.replay_marks) != 0 and self.replay_marks[0][1] <= oldest:
+                self.replay_marks.popleft()
+            owned_until = oldest
+            for global_appended, appended in self.replay_marks:
+                if global_appended > global_oldest:
+                    break
+                owned_until = appended
+            return owned_until - oldest
+
+        def memoryUsage(self):
+            # Approximate bytes held by each buffer, extrapolated from the size of one entry. A transition is counted
+            # once, by the global replay while it holds it, other replays count the pointers to it.
+            usage = {'replay': 0, 'initiation': 0, 'stats': 0}
+            if len(self.experience) != 0:
+                usage['replay'] = len(self.experience)*replay_slot_bytes + \
+                    self.numOwnedTransitions()*experienceBytes(self.experience[0])
+            usage['initiation'] = self.initiation_store.nbytes()
+            usage['stats'] = sys.getsizeof(self.num_updates_per_ep) + sys.getsizeof(self.size_exp_buff_per_ep)
+            return usage
+
+        def executionRate(self, ep):
+            # steps executed per episode since the option was created
+            return self.total_steps/float(ep - self.start_ep + 1)
+
+        def evictInitiationExamples(self):
+            # Once the classifier is done training the examples are never used again
+            if not self.classifierTrained() or len(self.initiation_store) == 0:
+                return False
+            print "Evicting", len(self.initiation_store), "initiation examples of option", self.n
+            self.initExamplesEvicted = True
+            self.initiation_store = InitiationExampleStore(max_fit_examples, init_example_resolution, \
+                initial_capacity = 0)
+            return True
+
+        def trimReplay(self):
+            # Drop the transitions that only this replay still holds, none are left once the global replay is trimmed
+            num_owned = 0 if self == globalMDP else self.numOwnedTransitions()
+            if num_owned == 0:
+                return False
+            print "Trimming option", self.n, "replay by", num_owned, "transitions no longer in the global replay"
+            for _ in range(num_owned):
+                self.experience.popleft()
+            return True
+
+        def shrinkReplay(self):
+            # Keep the most recent half of the experience, the buffer doesn't grow back past that
+            new_capacity = max(min_replay_evicted, len(self.experience)//2)
+            if new_capacity >= len(self.experience):
+                return False
+            print "Shrinking option", self.n, "replay from", len(self.experience), "to", new_capacity, "transitions"
+            self.experience = deque(list(self.experience)[-new_capacity:], maxlen=new_capacity)
+            return True
+
+        def copyDQNWeights(self, source):
+            print "Copying weights for new option", self.n, "from", source.n
+            sess.run(copy_network_op, feed_dict={copy_src_ph: [source.idx], copy_dst_ph: [self.idx]})
+
+        def greedyAction(self, observation):
+            q_s = sess.run(q_action_values, \
+                feed_dict = {opt_idx_ph: [self.idx], state_ph: observation[None, None], is_training_ph: False})
+            return np.argmax(q_s)
 
         def addInitiationExamples(self, states, label):
-            self.initiation_examples += states
-            self.initiation_labels += [label]*len(states)
+            self.initiation_store.add(states, label)
 
         def inInitiationSet(self, state):
-            return self.initTrained and self.initiation_classifier.predict([state])[0]
+            return self.initTrained and init_index.queryOption([state], self.idx)[0]
 
         # TODO: epsilon decay
         def updateEpsilon(self, done, ep):
@@ -351,26 +634,121 @@ def main():
                 #print "Updating option", self.n, "epsilon from", old_epsilon, "to", self.epsilon, "with", decay, "decay."
 
         def updateDQN(self, step_experience, episode):
-            self.experience.append(step_experience)
+            self.appendExperience(step_experience)
+            if self.idx == global_idx:
+                replay_masks.add(step_experience[0][:2])
 
             # update the slow target's weights to match the latest q network if it's time to do so
-            if self.total_steps%update_slow_target_every == 0:
-                _ = self.sess.run(update_slow_target_op)
-
-            # update network weights to fit a minibatch of experience
-            if self.total_steps%train_every == 0 and len(self.experience) >= minibatch_size:
-
-                # grab N (s,a,r,s') tuples from experience
-                minibatch = random.sample(self.experience, minibatch_size)
-
-                # do a train_op with all the inputs required
-
-                _ = self.sess.run(train_op,
-                    feed_dict = {state_ph: getMinibatchElem(minibatch, 0), action_ph: getMinibatchElem(minibatch, 1), \
-                        reward_ph: getMinibatchElem(minibatch, 2), next_state_ph: getMinibatchElem(minibatch, 3), \
-                        is_not_terminal_ph: getMinibatchElem(minibatch, 4), is_training_ph: True})
-                self.num_updates_per_ep[episode] += 1
-                self.size_exp_buff_per_ep[episode] = len(self.experience)
+            if self.num_update_calls%update_slow_target_every == 0:
+                self.target_update_pending = True
+
+            # queue an update of the network weights to fit a minibatch of experience, run by trainPendingOptions
+            if scheduler.shouldUpdate(self.num_update_calls, len(self.experience)):
+                self.pending_scales.append(scheduler.scaleFor(len(self.experience)))
+            self.num_update_calls += 1
+
+    def offPolicyMinibatches(options, batch_size):
+        # Replay rows of global transitions, filtered by the initiation bits stored with them
+        global_mdp = options[0]
+        replay_size = len(global_mdp.experience)
+        replay_masks.rescore(replay_size)
+        sample = np.random.randint(replay_size, size=min(replay_size, off_policy_sample_size))
+        minibatches = {}
+        for option in options[1:]:
+            matches = sample[replay_masks.matches(sample, replay_size, option.idx)]
+            if len(matches) >= off_policy_min_matches:
+                minibatches[option] = [global_mdp.experience[i] for i in np.random.choice(matches, batch_size)]
+        return minibatches
+
+    def trainPendingOptions(options, episode):
+        # Slow target updates come first, as they did before each option's own update
+        sync_idx = [option.idx for option in options if option.target_update_pending]
+        if len(sync_idx) != 0:
+            _ = sess.run(update_slow_target_op, feed_dict={opt_idx_ph: sync_idx})
+            for option in options:
+                option.target_update_pending = False
+
+        # Updates keep the scale they were queued at, even if the scheduler switches scale during the updates below.
+        # Options whose replay is too small for the current scale were queued at the base scale.
+        global_mdp = options[0]
+        queued_scales = [option.pending_scales for option in options]
+        for option in options:
+            option.pending_scales = []
+        for scale in sorted(set(sum(queued_scales, []))):
+            batch_size = scheduler.batchSize(scale)
+            batch_lr = scheduler.learningRate(scale)
+
+            # Minibatches owed to each option at this scale: None for an on-policy update sampled from its own
+            # experience, plus one off-policy minibatch whenever the global MDP trains
+            queued = [[None]*option_scales.count(scale) for option_scales in queued_scales]
+            if len(queued_scales[0]) != 0 and queued_scales[0][0] == scale:
+                off_policy = offPolicyMinibatches(options, batch_size)
+                for i, option in enumerate(options):
+                    if option in off_policy:
+                        queued[i].append(off_policy[option])
+
+            # One batched gradient step for every option with a queued update per session call
+            pending = [(option, queue) for option, queue in zip(options, queued) if len(queue) != 0]
+            while len(pending) != 0:
+                update_start_time = time.time()
+                # grab N (s,a,r,s') tuples for each option
+                minibatches = []
+                for option, queue in pending:
+                    minibatch = queue.pop(0)
+                    if minibatch == None:
+                        minibatch = random.sample(option.experience, batch_size)
+                    minibatches.append(minibatch)
+
+                # do a train_op with all the inputs required, stacked along the option dimension
+                _ = sess.run(train_op,
+                    feed_dict = {opt_idx_ph: [option.idx for option, _queue in pending], \
+                        state_ph: getStackedMinibatchElem(minibatches, 0), \
+                        action_ph: getStackedMinibatchElem(minibatches, 1), \
+                        reward_ph: getStackedMinibatchElem(minibatches, 2), \
+                        next_state_ph: getStackedMinibatchElem(minibatches, 3), \
+                        is_not_terminal_ph: getStackedMinibatchElem(minibatches, 4), is_training_ph: True, \
+                        lr_ph: batch_lr})
+                for option, _queue in pending:
+                    option.num_updates_per_ep[episode] += 1
+                    option.size_exp_buff_per_ep[episode] = len(option.experience)
+                scheduler.recordUpdate(time.time() - update_start_time, len(global_mdp.experience), scale)
+                pending = [(option, queue) for option, queue in pending if len(queue) != 0]
+
+    def memoryUsage(options, fixed_usage):
+        totals = dict(fixed_usage)
+        for option in options:
+            for component, num_bytes in option.memoryUsage().items():
+                totals[component] = totals.get(component, 0) + num_bytes
+        return totals
+
+    def enforceMemoryBudget(options, new_opt, ep, fixed_usage):
+        # Free memory until the tree fits in memory_budget: first the buffers only options done gestating hold, least
+        # executed first (initiation examples of finished classifiers, transitions the global replay has dropped),
+        # then the global replay, which holds every other transition, with the option replays trimmed to match
+        for option in options:
+            option.markReplay()
+        usage = memoryUsage(options, fixed_usage)
+        if sum(usage.values()) <= memory_budget:
+            return usage
+        candidates = sorted([option for option in options if option != new_opt], \
+            key = lambda option: option.executionRate(ep))
+        for evict in [Option.evictInitiationExamples, Option.trimReplay]:
+            evicted = True
+            while evicted and sum(usage.values()) > memory_budget:
+                evicted = False
+                for option in candidates:
+                    if evict(option):
+                        evicted = True
+                        usage = memoryUsage(options, fixed_usage)
+                        if sum(usage.values()) <= memory_budget:
+                            break
+        while sum(usage.values()) > memory_budget and globalMDP.shrinkReplay():
+            for option in options:
+                option.trimReplay()
+            usage = memoryUsage(options, fixed_usage)
+        if sum(usage.values()) > memory_budget:
+            print "Option tree is still over the memory budget after evicting everything it could."
+        return usage
 
     # http://anytree.readthedocs.io/en/latest/api/anytree.node.html#anytree.node.nodemixin.NodeMixin
     class Skill(Option, NodeMixin):
@@ -384,11 +762,7 @@ def main():
                 global_mdp = self.parent
                 while global_mdp.parent != None:
                     global_mdp = global_mdp.parent
-                # Timestamp shouldn't be necessary since only one model will be saved for each option
-                timestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d_%H_%M_%S')
-                weights_file = self.directory + '/' + timestamp + ".ckpt"
-                global_mdp.saveDQNWeights(weights_file)
-                self.loadDQNWeights(weights_file)
+                self.copyDQNWeights(global_mdp)
 
 
         def inTerminationSet(self, full_state, done):
@@ -407,7 +781,7 @@ def main():
                 # Only use the last max_neg_traj negative examples, not the hovering at the beginning
                 negative_examples = statesFromExperiences(experiences[-max_steps_opt-max_neg_traj:-max_steps_opt])
                 # If there aren't examples or if first negative example isn't already in the initiation set
-                if len(self.initiation_examples) == 0 or len(negative_examples) == 0 or not self.inInitiationSet(negative_examples[0]):
+                if len(self.initiation_store) == 0 or len(negative_examples) == 0 or not self.inInitiationSet(negative_examples[0]):
                     self.addInitiationExamples(positive_examples, 1)
                     self.addInitiationExamples(negative_examples, 0)
                     self.retrainInitationClassifier(ep)
@@ -418,14 +792,46 @@ def main():
     ####################################################################################################################
     ## Training
 
-    # initialize session
     globalMDP = Skill("GlobalMDP", 0)
 
     num_skills = 0
     goalOpt = Skill(num_skills, 0, parent=globalMDP)
     num_skills += 1
+    # every option in the tree, global MDP first, trained together after each step
+    options = [globalMDP, goalOpt]
+    # set once an option couldn't be created for lack of room in the stacked weights
+    opts_full = False
+    assert([option.idx for option in options] == range(len(options)))
+
+    def treeSnapshot():
+        bfs = optTreeToList(goalOpt)
+        return TreeSnapshot([option.idx for option in bfs], [(option.idx, option.parent.idx) for option in bfs], \
+            [option.idx for option in bfs if option.classifierTrained()], init_index)
+
+    def addActorExperience(cursor):
+        # Transitions the actors wrote since cursor go to the global MDP and to the option that took them
+        batch, cursor = fleet.replay.read(cursor)
+        replay_masks.add(batch[0][:, :2])
+        for s, a, r, s2, not_terminal, idx in zip(*batch):
+            exp = (s, a, r, s2, not_terminal)
+            globalMDP.appendExperience(exp)
+            # options is indexed by option index
+            if idx != global_idx and idx < len(options):
+                options[idx].appendExperience(exp)
+        return cursor
+
+    if fleet != None:
+        fleet.publishWeights(sess.run(q_network_vars))
+    actor_cursor = 0
+    learner_steps = 0
+    # buffers that don't belong to an option
+    fixed_usage = {'initiation masks': replay_masks.nbytes()}
+    if fleet != None:
+        fixed_usage['actor replay'] = sum(column.nbytes for column in fleet.replay.columns)
     # continually updated, set to new option whose initiation classifier is not fully trained, else set to None
     new_opt = goalOpt
+    recorder = TrajectoryRecorder(args.record, state_dim, max_steps_ep, args.record_every) \
+        if args.record != '' else None
 
     start_time = time.time()
     for ep in range(num_episodes):
@@ -438,42 +844,55 @@ def main():
         epi_experience = []
 
         observation = env.reset()
+        if recorder != None:
+            recorder.startEpisode(ep, observation)
 
         # Option to use at each step of this episode
         opt = globalMDP
         # Check to see if initiation classification is done
         if new_opt != None and new_opt.classifierTrained():
             new_opt = None
+        # Actors act with the tree as it is at the start of each episode
+        if fleet != None:
+            fleet.publishTree(treeSnapshot())
         # Drop all epsilons in the tree to zero
         if ep >= epsilon_drop_episode:
             dropAllEpsilon(globalMDP)
         for t in range(max_steps_ep):
             current_position = observation[:2]
 
+            for option in options:
+                option.pollClassifierFit(ep)
+
             # determine if we should switch to an option, create a new one, or continue to use global MDP
             if opt == globalMDP:
-                current_opt = findOptForState(current_position, goalOpt, ep)
+                current_opt = findOptForState(current_position, goalOpt, ep, init_index)
                 if current_opt != None:
                     opt = current_opt
                     print "Switching from global MDP to option", opt.name
                     # When transitioning to option from global, and no option is being initialized
-                    if new_opt == None and ep < add_opt_cutoff:
+                    if new_opt == None and ep < add_opt_cutoff and len(options) == max_num_opts and not opts_full:
+                        opts_full = True
+                        print "All", max_num_opts, "option networks are used, no more options will be created."
+                    if new_opt == None and ep < add_opt_cutoff and len(options) < max_num_opts:
                         print "Creating a new option with parent", opt.name
                         new_opt = Skill(num_skills, ep, parent=opt)
                         num_skills += 1
+                        options.append(new_opt)
                 else:
                     opt = globalMDP
 
             if np.random.random() < opt.epsilon:
                 action = np.random.randint(n_actions)
             else:
-                q_s = opt.sess.run(q_action_values, feed_dict = {state_ph: observation[None], is_training_ph: False})
-                action = np.argmax(q_s)
+                action = opt.greedyAction(observation)
 
             # take step
             next_observation, reward, done, _info = env.step(action)
             if args.visualize:
                 env.render()
+            if recorder != None:
+                recorder.step(action, reward, opt.idx, next_observation)
 
             opt_reward = reward
 
@@ -515,17 +934,39 @@ def main():
                     new_opt.updateDQN(exp, ep)
                 new_opt.updateInit(epi_experience, ep)
 
+            trainPendingOptions(options, ep)
+
+            if fleet != None:
+                actor_cursor = addActorExperience(actor_cursor)
+                learner_steps += 1
+                if learner_steps%publish_weights_every == 0:
+                    fleet.publishWeights(sess.run(q_network_vars))
+
             if done:
                 # Increment episode counter
-                _ = opt.sess.run(episode_inc_op)
+                _ = sess.run(episode_inc_op, feed_dict={opt_idx_ph: [opt.idx]})
                 break
 
+        if recorder != None and recorder.recording():
+            # the tree at the end of the episode, with any initiation classifiers fit during it, saved again only once
+            # a classifier, the set of options or which of them are trained changed
+            tree = treeSnapshot()
+            recorder.endEpisode(tree, dict((option.idx, option.name) for option in options), \
+                (init_index.version, len(options), len(tree.trained)))
+
         # TODO: only write once, writeEpsilon currently writes for all but global since nothing else is plotted
         writeAllEpsilon(globalMDP, ep)
         globalMDP.writeReward(raw_reward, ep)
 
         print('Episode %2i, Reward: %7.3f, Steps: %i, Minutes: %7.3f'%\
             (ep, raw_reward, steps_in_ep, (time.time() - start_time)/60))
+        usage = enforceMemoryBudget(options, new_opt, ep, fixed_usage)
+        print('Memory MB: %.1f of %.1f, '%(megabytes(sum(usage.values())), megabytes(memory_budget)) + \
+            ', '.join('%s %.1f'%(component, megabytes(num_bytes)) for component, num_bytes in sorted(usage.items())))
+        if fleet != None:
+            actor_rewards = [report[1] for report in fleet.episodeReports()]
+            if len(actor_rewards) != 0:
+                print('Actor episodes: %i, Mean reward: %7.3f'%(len(actor_rewards), np.mean(actor_rewards)))
     for option in optTreeToList(globalMDP):
         print option.name
         print
@@ -534,6 +975,20 @@ def main():
         print option.size_exp_buff_per_ep
         print
         print
+    # wait for the last classifier fits so the saved tree has them
+    for option in options:
+        if option.pending_fit != None:
+            option.pending_fit.wait()
+            option.refit_needed = False
+            option.pollClassifierFit(ep)
+    skill_tree_file = timestamp + '/skill_tree.pkl'
+    print "Saving skill tree to", skill_tree_file
+    saveSkillTree(skill_tree_file, [var[:len(options)] for var in sess.run(q_network_vars)], treeSnapshot(), \
+        dict((option.idx, option.name) for option in options))
+
+    if fleet != None:
+        fleet.stop()
+    classifier_pool.terminate()
     env.close()
 
 if __name__ == '__main__':
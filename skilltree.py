@@ -0,0 +1,252 @@
+# Matt Corsaro
+# Brown University CS 2951X Final Project
+# Skill chaining for continuous Lunar Lander
+# Parts of the option tree that only need numpy, shared by the learner and by processes that just act with the tree
+import numpy as np
+
+import pickle
+
+# Stacked network index of the global MDP, options follow in creation order
+global_idx = 0
+
+def atGoal(state, done):
+    # If landed in the target zone (between the two flags)
+    x = state[0]
+    y = state[1]
+    return -0.2 < x < 0.2 and -0.1 < y < 0.1 and done
+
+# Support vectors of every option's RBF initiation classifier concatenated into one set of arrays, so that a batch of
+# states can be classified against all options with a single kernel evaluation instead of one predict call per
+# state and option.
+class InitiationSetIndex(object):
+    def __init__(self, num_opts):
+        self.num_opts = num_opts
+        # option index -> fitted svm.SVC
+        self.classifiers = {}
+        # bumped whenever a classifier changes
+        self.version = 0
+        self.rebuild()
+
+    def update(self, idx, classifier):
+        self.classifiers[idx] = classifier
+        self.version += 1
+        self.rebuild()
+
+    def rebuild(self):
+        support_vectors = [np.zeros((0, 2))]
+        gammas = [np.zeros(0)]
+        dual_coefs = [np.zeros(0)]
+        owners = [np.zeros(0, dtype=int)]
+        self.intercepts = np.zeros(self.num_opts)
+        self.trained = np.zeros(self.num_opts, dtype=bool)
+        # option index -> (first, last + 1) row of its support vectors
+        self.sv_ranges = {}
+        num_sv = 0
+        for idx, clf in self.classifiers.items():
+            n_sv = clf.support_vectors_.shape[0]
+            self.sv_ranges[idx] = (num_sv, num_sv + n_sv)
+            num_sv += n_sv
+            support_vectors.append(clf.support_vectors_)
+            # _gamma holds the value actually used by the fit, whether gamma was given or 'auto'/'scale'
+            gammas.append(np.full(n_sv, clf._gamma))
+            # for binary SVC, dual_coef_ and intercept_ are signed so that decision > 0 predicts classes_[1]
+            dual_coefs.append(clf.dual_coef_[0])
+            owners.append(np.full(n_sv, idx, dtype=int))
+            self.intercepts[idx] = clf.intercept_[0]
+            self.trained[idx] = True
+        self.support_vectors = np.concatenate(support_vectors)
+        self.sv_sq_norms = np.sum(self.support_vectors**2, axis=1)
+        self.gammas = np.concatenate(gammas)
+        self.dual_coefs = np.concatenate(dual_coefs)
+        # [num support vectors, num options] indicator used to sum kernel terms per option
+        self.owner_matrix = np.zeros((self.support_vectors.shape[0], self.num_opts))
+        self.owner_matrix[np.arange(self.support_vectors.shape[0]), np.concatenate(owners)] = 1.
+
+    def decisionFunction(self, states):
+        # states: [N, 2] positions, returns [N, num_opts] SVM decision values
+        states = np.asarray(states, dtype=float).reshape(-1, 2)
+        sq_dists = np.sum(states**2, axis=1)[:, None] + self.sv_sq_norms[None, :] - \
+            2*states.dot(self.support_vectors.T)
+        kernel = np.exp(-self.gammas[None, :]*np.maximum(sq_dists, 0))
+        return (kernel*self.dual_coefs[None, :]).dot(self.owner_matrix) + self.intercepts[None, :]
+
+    def query(self, states):
+        # [N, num_opts] boolean, True where the state is in that option's (trained) initiation set
+        return (self.decisionFunction(states) > 0) & self.trained[None, :]
+
+    def queryOption(self, states, idx, dtype = np.float64):
+        # [N] boolean for one option only, against its own support vectors: for checking a state against a single
+        # initiation set, or (in float32) classifying many states when just that option's classifier changed
+        states = np.asarray(states, dtype=dtype).reshape(-1, 2)
+        if not self.trained[idx]:
+            return np.zeros(len(states), dtype=bool)
+        first, last = self.sv_ranges[idx]
+        support_vectors = self.support_vectors[first:last].astype(dtype)
+        sq_dists = np.sum(states**2, axis=1)[:, None] + np.sum(support_vectors**2, axis=1)[None, :] - \
+            2*states.dot(support_vectors.T)
+        kernel = np.exp(dtype(-self.gammas[first])*np.maximum(sq_dists, 0))
+        return kernel.dot(self.dual_coefs[first:last].astype(dtype)) + self.intercepts[idx] > 0
+
+    # Classifiers hold a reference to the training data and need sklearn, only the arrays are needed to query
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['classifiers'] = {}
+        return state
+
+# Which trained initiation sets the start state of each global replay transition is in, one bit per option, so
+# off-policy minibatches can be picked without classifying replay states every step. Transitions are classified once
+# when they are added. When an option's classifier changes, its bit is stale for the transitions already stored: they
+# are reclassified for that option a chunk at a time, most recent first, and don't match it until then.
+# Entries are addressed by how many transitions were added before them, the replay holds the most recent ones.
+class InitiationMasks(object):
+    def __init__(self, capacity, init_index, rescore_chunk):
+        assert(init_index.num_opts <= 64)
+        self.capacity = capacity
+        self.init_index = init_index
+        self.rescore_chunk = rescore_chunk
+        self.positions = np.zeros((capacity, 2), dtype=np.float32)
+        self.masks = np.zeros(capacity, dtype=np.uint64)
+        self.bits = np.uint64(1) << np.arange(init_index.num_opts, dtype=np.uint64)
+        self.num_added = 0
+        # per option, transitions added before this one still have a stale bit
+        self.stale_end = np.zeros(init_index.num_opts, dtype=np.int64)
+
+    def add(self, positions):
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 2)
+        slots = (self.num_added + np.arange(len(positions)))%self.capacity
+        self.positions[slots] = positions
+        self.masks[slots] = np.sum(self.init_index.query(positions)*self.bits[None, :], axis=1, dtype=np.uint64)
+        self.num_added += len(positions)
+
+    def invalidate(self, idx):
+        # call once init_index has the option's new classifier
+        self.stale_end[idx] = self.num_added
+
+    def rescore(self, replay_size):
+        # Reclassify one chunk of stale transitions still in the replay, for the option with the most recent ones
+        oldest = self.num_added - replay_size
+        stale = np.nonzero(self.stale_end > oldest)[0]
+        if len(stale) == 0:
+            return
+        idx = stale[np.argmax(self.stale_end[stale])]
+        first = max(oldest, self.stale_end[idx] - self.rescore_chunk)
+        slots = np.arange(first, self.stale_end[idx])%self.capacity
+        in_init = self.init_index.queryOption(self.positions[slots], idx, np.float32)
+        self.masks[slots] = np.where(in_init, self.masks[slots] | self.bits[idx], self.masks[slots] & ~self.bits[idx])
+        self.stale_end[idx] = first
+
+    def matches(self, replay_rows, replay_size, idx):
+        # which of the given replay rows (0 is the oldest transition) start in the option's initiation set
+        added = self.num_added - replay_size + np.asarray(replay_rows)
+        return (added >= self.stale_end[idx]) & ((self.masks[added%self.capacity] & self.bits[idx]) != 0)
+
+    def nbytes(self):
+        return self.positions.nbytes + self.masks.nbytes
+
+# Growable array of (x, y) initiation examples and their labels. Keeps running label counts, drops examples that fall
+# in a grid cell already holding an example with the same label, and keeps a reservoir sample per label so the
+# classifier can be fit on a class-balanced subset of bounded size however many trajectories have been added.
+class InitiationExampleStore(object):
+    def __init__(self, max_fit_examples, resolution, initial_capacity = 1024):
+        self.max_fit_examples = max_fit_examples
+        self.resolution = resolution
+        self.examples = np.zeros((initial_capacity, 2))
+        self.labels = np.zeros(initial_capacity, dtype=int)
+        self.size = 0
+        # examples offered to add, near-duplicates included
+        self.num_offered = 0
+        # stored examples per label
+        self.counts = [0, 0]
+        # (grid cell x, grid cell y, label) of every stored example
+        self.cells = set()
+        # per label, indices of the stored examples in its reservoir sample
+        self.reservoirs = [[], []]
+
+    def __len__(self):
+        return self.size
+
+    def add(self, states, label):
+        states = np.asarray(states, dtype=float).reshape(-1, 2)
+        self.num_offered += len(states)
+        reservoir_size = self.max_fit_examples//2
+        for state, cell in zip(states, np.floor(states/self.resolution).astype(int)):
+            key = (cell[0], cell[1], label)
+            if key in self.cells:
+                continue
+            self.cells.add(key)
+            if self.size == len(self.labels):
+                capacity = max(2*self.size, 16)
+                self.examples = np.concatenate([self.examples, np.zeros((capacity - self.size, 2))])
+                self.labels = np.concatenate([self.labels, np.zeros(capacity - self.size, dtype=int)])
+            self.examples[self.size] = state
+            self.labels[self.size] = label
+            self.counts[label] += 1
+            # reservoir sampling (Algorithm R) over this label's examples
+            reservoir = self.reservoirs[label]
+            if len(reservoir) < reservoir_size:
+                reservoir.append(self.size)
+            else:
+                replace = np.random.randint(self.counts[label])
+                if replace < reservoir_size:
+                    reservoir[replace] = self.size
+            self.size += 1
+
+    def numPositive(self):
+        return self.counts[1]
+
+    def numNegative(self):
+        return self.counts[0]
+
+    def storedExamples(self):
+        # views of the stored examples and labels
+        return self.examples[:self.size], self.labels[:self.size]
+
+    def fitExamples(self):
+        # up to max_fit_examples/2 examples of each label
+        rows = np.array(sorted(self.reservoirs[0] + self.reservoirs[1]), dtype=int)
+        return self.examples[rows], self.labels[rows]
+
+    def nbytes(self):
+        # arrays, plus roughly 100 bytes per grid cell key and 8 per reservoir index
+        return self.examples.nbytes + self.labels.nbytes + 100*len(self.cells) + \
+            8*(len(self.reservoirs[0]) + len(self.reservoirs[1]))
+
+# The option tree as seen by processes that act with it but don't train it: BFS order starting at the goal option,
+# parents, which initiation classifiers are done training, and the initiation index.
+class TreeSnapshot(object):
+    def __init__(self, bfs_order, parents, trained, init_index):
+        self.bfs_order = list(bfs_order)
+        # option index -> parent option index
+        self.parents = dict(parents)
+        self.trained = set(trained)
+        self.init_index = init_index
+
+    def findOption(self, position):
+        return self.firstOption(self.init_index.query([position])[0])
+
+    def firstOption(self, in_init):
+        # Same as findOptForState: first option in BFS order whose fully trained initiation set contains the state,
+        # given the state's row of an init_index query
+        for idx in self.bfs_order:
+            if idx in self.trained and in_init[idx]:
+                return idx
+        return global_idx
+
+    def inTerminationSet(self, idx, full_state, done):
+        if idx == global_idx:
+            return False
+        elif self.parents[idx] == global_idx:
+            # the goal option
+            return atGoal(full_state, done)
+        else:
+            return self.init_index.queryOption([full_state[:2]], self.parents[idx])[0]
+
+# A trained skill tree: stacked network weights indexed by option index, the tree snapshot and option names
+def saveSkillTree(filename, weights, tree, names):
+    with open(filename, 'wb') as f:
+        pickle.dump({'weights': weights, 'tree': tree, 'names': names}, f, pickle.HIGHEST_PROTOCOL)
+
+def loadSkillTree(filename):
+    with open(filename, 'rb') as f:
+        skill_tree = pickle.load(f)
+    return skill_tree['weights'], skill_tree['tree'], skill_tree['names']
@@ -0,0 +1,86 @@
+# Matt Corsaro
+# Brown University CS 2951X Final Project
+# Skill chaining for continuous Lunar Lander
+# Records the states, actions, rewards and acting option of selected episodes, so they can be rendered offline
+# (render_trajectories.py) instead of calling env.render() in the stepping loop
+import numpy as np
+
+import os
+import glob
+
+from skilltree import saveSkillTree, loadSkillTree
+
+class TrajectoryRecorder(object):
+    def __init__(self, directory, state_dim, max_steps_ep, record_every = 1):
+        self.directory = directory
+        self.record_every = record_every
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # states[t+1] follows actions[t], taken by options[t]; filled in place so recording a step costs a few copies
+        self.states = np.zeros((max_steps_ep + 1, state_dim), dtype=np.float32)
+        self.actions = np.zeros(max_steps_ep, dtype=np.int8)
+        self.rewards = np.zeros(max_steps_ep, dtype=np.float32)
+        self.options = np.zeros(max_steps_ep, dtype=np.int8)
+        self.ep = None
+        self.num_steps = 0
+        # version and file name of the last option tree saved, episodes played with the same tree refer to that file
+        self.tree_version = None
+        self.tree_file = ''
+
+    def recording(self):
+        return self.ep != None
+
+    def startEpisode(self, ep, observation):
+        # episodes that aren't recorded cost one check per step
+        self.ep = ep if ep%self.record_every == 0 else None
+        self.num_steps = 0
+        if self.ep != None:
+            self.states[0] = observation
+
+    def step(self, action, reward, opt, next_observation):
+        if self.ep == None:
+            return
+        t = self.num_steps
+        self.actions[t] = action
+        self.rewards[t] = reward
+        self.options[t] = opt
+        self.states[t + 1] = next_observation
+        self.num_steps += 1
+
+    def endEpisode(self, tree = None, names = None, tree_version = None):
+        # tree and names: the option tree the episode was played with, for its initiation regions. It is only saved
+        # when tree_version differs from the last saved tree's (always when tree_version is None).
+        if self.ep == None:
+            return
+        if tree != None and (tree_version == None or tree_version != self.tree_version):
+            self.tree_version = tree_version
+            self.tree_file = 'tree_%05i.pkl'%self.ep
+            saveSkillTree(os.path.join(self.directory, self.tree_file), None, tree, names)
+        t = self.num_steps
+        np.savez(episodeFile(self.directory, self.ep), episode=self.ep, states=self.states[:t + 1], \
+            actions=self.actions[:t], rewards=self.rewards[:t], options=self.options[:t], \
+            tree_file=self.tree_file if tree != None else '')
+        self.ep = None
+
+def episodeFile(directory, ep):
+    return os.path.join(directory, 'episode_%05i.npz'%ep)
+
+def recordedEpisodes(directory):
+    return sorted(int(os.path.basename(filename)[len('episode_'):-len('.npz')]) \
+        for filename in glob.glob(os.path.join(directory, 'episode_*.npz')))
+
+def loadEpisode(directory, ep, trees = None):
+    # (trajectory dict, tree, names), tree and names are None for a DQN episode. trees: optional dict caching the
+    # loaded tree files across calls
+    with np.load(episodeFile(directory, ep)) as data:
+        trajectory = dict((key, data[key]) for key in data.files)
+    tree_file = str(trajectory.pop('tree_file'))
+    if tree_file == '':
+        return trajectory, None, None
+    if trees == None:
+        trees = {}
+    if tree_file not in trees:
+        _weights, tree, names = loadSkillTree(os.path.join(directory, tree_file))
+        trees[tree_file] = (tree, names)
+    tree, names = trees[tree_file]
+    return trajectory, tree, names